@@ -0,0 +1,182 @@
+"""Offline end-to-end benchmark of the bot.
+
+Starts local fakes of Dify and the Telegram Bot API, builds the dispatcher of
+``start_bot`` against them and replays synthetic private, group mention, group
+chatter and join updates at a fixed arrival rate. Prints (or writes) a JSON
+report with throughput, latency percentiles and peak memory.
+
+Run with ``python -m benchmarks.bench_e2e --updates 1000 --rate 100 --output result.json``.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeDify, FakeTelegram, serve
+
+KINDS = ("private", "mention", "chatter", "join")
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 2)
+
+    return {"count": len(ordered), "p50": pick(50), "p95": pick(95), "p99": pick(99), "max": pick(100)}
+
+
+def build_update(update_id: int, kind: str, rnd: random.Random, chats: int, bot_username: str) -> dict:
+    user_id = rnd.randint(1, 10 ** 6)
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    group = {"id": -1000000000000 - rnd.randrange(chats), "type": "supergroup", "title": "bench"}
+    if kind == "join":
+        return {"update_id": update_id, "chat_member": {
+            "chat": group, "from": user, "date": int(time.time()),
+            "old_chat_member": {"status": "left", "user": user},
+            "new_chat_member": {"status": "member", "user": user},
+        }}
+    message = {"message_id": update_id, "date": int(time.time()), "from": user}
+    if kind == "private":
+        message.update(chat={"id": user_id, "type": "private", "first_name": user["first_name"]},
+                       text="你好，帮我介绍一下这个项目？")
+    elif kind == "mention":
+        mention = f"@{bot_username}"
+        message.update(chat=group, text=f"{mention} 今天有什么新闻？",
+                       entities=[{"type": "mention", "offset": 0, "length": len(mention)}])
+    else:
+        message.update(chat=group, text="大家好，今天天气不错")
+    return {"update_id": update_id, "message": message}
+
+
+async def run(args: argparse.Namespace) -> dict:
+    dify = FakeDify(first_byte_latency=args.dify_latency, token_rate=args.token_rate)
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    dify_runner, dify_url = await serve(dify.app())
+    telegram_runner, telegram_url = await serve(telegram.app())
+
+    # the configuration is read when src is imported
+    os.environ.update({
+        "DIFY_API_KEY": "bench", "DIFY_BASE_URL": dify_url,
+        "NEWS_API_KEY": "bench", "NEWS_BASE_URL": dify_url,
+        "TG_GROUP_ID": "", "WEBHOOK_URL": "",
+        "CONVERSATION_DB_PATH": args.db,
+        # every run replays the same update ids, the offsets of a previous run would drop them
+        "UPDATE_OFFSETS_PATH": os.path.join(tempfile.mkdtemp(), "offsets.json"),
+    })
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    from src.bot.__main__ import create_dispatcher
+    from src.configuration import conf
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(telegram_url))
+    bots = [Bot(token=f"{100 + i}:bench", session=session, default=DefaultBotProperties(parse_mode="MarkdownV2"))
+            for i in range(3)]
+    dispatcher = create_dispatcher(*bots)
+    bot = bots[0]
+    bot_username = (await bot.me()).username
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher, bots=bots)
+
+    rnd = random.Random(args.seed)
+    weights = [float(weight) for weight in args.mix.split(",")]
+    latencies: dict[str, list[float]] = {kind: [] for kind in KINDS}
+    errors = 0
+    joins: dict[int, float] = {}
+
+    async def feed(update_id: int, kind: str) -> None:
+        nonlocal errors
+        raw = build_update(update_id, kind, rnd, args.chats, bot_username)
+        update = Update.model_validate(raw, context={"bot": bot})
+        started = time.perf_counter()
+        if kind == "join":
+            joins.setdefault(update.chat_member.chat.id, started)
+        try:
+            await dispatcher.feed_update(bot, update)
+        except Exception:
+            errors += 1
+        latencies[kind].append(time.perf_counter() - started)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    tasks = []
+    started = time.perf_counter()
+    for update_id in range(1, args.updates + 1):
+        kind = rnd.choices(KINDS, weights)[0]
+        tasks.append(asyncio.create_task(feed(update_id, kind)))
+        await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+
+    # welcomes are sent after the batching window
+    deadline = time.perf_counter() + conf.welcome.batch_window + args.drain_timeout
+    while time.perf_counter() < deadline and any(not telegram.sent.get(chat) for chat in joins):
+        await asyncio.sleep(0.1)
+    welcome_latencies = [
+        min(sent for sent in telegram.sent[chat] if sent >= joined) - joined
+        for chat, joined in joins.items() if any(sent >= joined for sent in telegram.sent.get(chat, []))
+    ]
+    tracemalloc_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher, bots=bots)
+    await session.close()
+    await dify_runner.cleanup()
+    await telegram_runner.cleanup()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "updates": len(all_latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round(len(all_latencies) / duration, 2),
+        "latency_ms": {"all": percentiles(all_latencies), **{kind: percentiles(latencies[kind]) for kind in KINDS}},
+        "welcome_latency_ms": {**percentiles(welcome_latencies), "chats": len(joins)},
+        "dify": {"requests": dify.requests, "max_concurrent": dify.max_active},
+        "telegram_calls": dict(telegram.calls),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "tracemalloc_peak_mb": round(tracemalloc_peak / 2 ** 20, 1) if tracemalloc_peak is not None else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500, help="number of updates to replay")
+    parser.add_argument("--rate", type=float, default=100, help="updates per second")
+    parser.add_argument("--mix", default="4,3,2,1", help="weights of private,mention,chatter,join updates")
+    parser.add_argument("--chats", type=int, default=200, help="number of distinct groups")
+    parser.add_argument("--dify-latency", type=float, default=0.3, help="Dify first byte latency in seconds")
+    parser.add_argument("--token-rate", type=float, default=200, help="Dify answer events per second")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Bot API latency in seconds")
+    parser.add_argument("--db", default="", help="conversation SQLite file, in memory when empty")
+    parser.add_argument("--drain-timeout", type=float, default=5, help="seconds to wait for pending welcomes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the tracemalloc peak (slower)")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Benchmark of the MarkdownV2 escaper with an equivalence fuzz against the previous implementation.
+
+Run with ``python -m benchmarks.bench_markdown [fuzz_cases] [seed]``.
+"""
+import random
+import re
+import sys
+import timeit
+
+from src.bot.markdown import _pieces, escape_markdown_v2, split_markdown_v2
+
+
+def legacy_escape_markdown_v2(text: str) -> str:
+    """``escape_markdown_v2`` as it was in ``src/bot/__main__.py`` before the single-pass rewrite."""
+    pattern = re.compile(
+        r'(\[.*?\]\(\S*?\))'
+        r'|(\*\*.*?\*\*)'
+        r'|(\*.*?\*)'
+        r'|(__.*?__)'
+        r'|(_.*?_)'
+        r'|(`.*?`)'
+        r'|(```[\s\S]*?```)'
+        r'|\\n'
+        , re.DOTALL)
+
+    parts = []
+    last_end = 0
+
+    for match in pattern.finditer(text):
+        start = match.start()
+        end = match.end()
+
+        if start > last_end:
+            plain_text = text[last_end:start]
+            parts.append(_legacy_escape_plain_text(plain_text))
+        group_text = match.group()
+        if match := re.match(r'\[(.*?)\]\((\S*?)\)', group_text, re.DOTALL):
+            link_text = match.group(1)
+            link_url = match.group(2)
+            parts.append(f'[{_legacy_escape_plain_text(link_text)}]({_legacy_escape_plain_text(link_url)})')
+        elif match := re.match(r'\*\*(.*?)\*\*', group_text, re.DOTALL):
+            txt = match.group(1)
+            parts.append(f'**{_legacy_escape_plain_text(txt)}**')
+        elif match := re.match(r'__(.*?)__', group_text, re.DOTALL):
+            txt = match.group(1)
+            parts.append(f'__{_legacy_escape_plain_text(txt)}__')
+        elif match := re.match(r'_(.*?)_', group_text):
+            txt = match.group(1)
+            parts.append(f'_{_legacy_escape_plain_text(txt)}_')
+        elif match := re.match(r'`(.*?)`', group_text):
+            txt = match.group(1)
+            parts.append(f'`{_legacy_escape_plain_text(txt)}`')
+        elif match := re.match(r'```([\s\S]*?)```', group_text):
+            txt = match.group(1)
+            parts.append(f'```{_legacy_escape_plain_text(txt)}```')
+        elif re.match(r'\\n', group_text):
+            parts.append(f'\n')
+        else:
+            parts.append(group_text)
+        last_end = end
+
+    if last_end < len(text):
+        plain_text = text[last_end:]
+        parts.append(_legacy_escape_plain_text(plain_text))
+
+    return ''.join(parts)
+
+
+def _legacy_escape_plain_text(text: str) -> str:
+    return re.sub(pattern=re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])"), repl=r'\\\1', string=text)
+
+
+ALPHABET = ["a", "b", " ", "\n", "_", "__", "*", "**", "`", "```", "[", "]", "(", ")", "\\n", "\\", ".", "!", "-",
+            "#", "~", "|", "你好", "😀", "http://x.y/z"]
+
+
+def random_text(rnd: random.Random, max_tokens: int = 40) -> str:
+    return "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, max_tokens)))
+
+
+def fuzz(cases: int, seed: int) -> None:
+    rnd = random.Random(seed)
+    for _ in range(cases):
+        text = random_text(rnd)
+        expected = legacy_escape_markdown_v2(text)
+        actual = escape_markdown_v2(text)
+        assert actual == expected, (text, expected, actual)
+
+        limit = rnd.randint(8, 64)
+        chunks = split_markdown_v2(text, limit=limit)
+        assert all(0 < len(chunk) <= limit for chunk in chunks), (text, limit, chunks)
+        assert all(not chunk.endswith("\\") or chunk.endswith("\\\\") for chunk in chunks), (text, limit, chunks)
+        # only formatted parts longer than the limit are changed (they fall back to plain text)
+        if all(source is None or len(piece) <= limit for piece, source in _pieces(text)):
+            assert "".join(chunks) == expected, (text, limit, chunks)
+    print(f"fuzz: {cases} cases equal to the legacy implementation (seed={seed})")
+
+
+def news_digest() -> str:
+    line = ("**今日新闻** 第{i}条：[链接](https://example.com/news/{i}) 某公司发布了新产品 v2.0，"
+            "价格为 $99.99 (限时!) _据报道_ 用户反馈 `great` -- 详见官网。\\n")
+    return "".join(line.format(i=i) for i in range(60))
+
+
+def bench() -> None:
+    for name, text in (("reply", "你好 @user，这是 *一条* 普通的回复，包含 [链接](https://t.me) 和 `代码`。"),
+                       ("news digest", news_digest())):
+        assert escape_markdown_v2(text) == legacy_escape_markdown_v2(text)
+        number = 2000 if len(text) < 1000 else 200
+        legacy = min(timeit.repeat(lambda: legacy_escape_markdown_v2(text), number=number, repeat=5)) / number
+        current = min(timeit.repeat(lambda: escape_markdown_v2(text), number=number, repeat=5)) / number
+        print(f"{name} ({len(text)} chars): legacy {legacy * 1e6:9.1f} us, "
+              f"single-pass {current * 1e6:9.1f} us ({legacy / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    cases, seed = (args + [20000, 0][len(args):])[:2]
+    fuzz(cases, seed)
+    bench()
@@ -0,0 +1,97 @@
+"""Microbenchmark of the SSE stream decoding against the previous line based loop.
+
+Run with ``python -m benchmarks.bench_sse [answer_tokens] [rounds]``.
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+
+from aiohttp import StreamReader
+from aiohttp.base_protocol import BaseProtocol
+
+from src.agent.base import BaseClient, Response
+from src.agent.sse import SSEDecoder
+
+
+async def legacy_read(content: StreamReader) -> Response:
+    """The decoding loop ``BaseClient._make_streaming_request`` used before ``SSEDecoder``."""
+    message = ""
+    async for line in content:
+        if line:
+            try:
+                data = json.loads(line.decode("utf-8").replace("data: ", ""))
+                event_type = data.get("event")
+
+                if event_type == "message":
+                    message += data.get("answer", "")
+                elif event_type == "message_end":
+                    message_obj = json.loads(message)
+                    return Response(**message_obj, conversation_id=data.get("conversation_id"))
+            except json.JSONDecodeError:
+                continue
+    return Response(need_response=False, message="", conversation_id='')
+
+
+def build_stream(tokens: int) -> bytes:
+    """Build a chat-messages stream whose answer is split into ``tokens`` events."""
+    answer = json.dumps({"need_response": True, "message": "你好，世界 hello world " * (tokens // 4 + 1)})
+    size = max(1, len(answer) // tokens)
+    events = [b"event: ping\n\n"]
+    for i in range(0, len(answer), size):
+        payload = {"event": "message", "conversation_id": "c1", "answer": answer[i:i + size]}
+        events.append(b"data: " + json.dumps(payload, ensure_ascii=False).encode() + b"\n\n")
+    events.append(b'data: {"event": "message_end", "conversation_id": "c1"}\n\n')
+    return b"".join(events)
+
+
+def split_chunks(stream: bytes, seed: int = 0) -> list[bytes]:
+    """Cut the stream at random offsets like network reads do."""
+    rnd = random.Random(seed)
+    chunks, position = [], 0
+    while position < len(stream):
+        size = rnd.randint(64, 4096)
+        chunks.append(stream[position:position + size])
+        position += size
+    return chunks
+
+
+def make_reader(chunks: list[bytes]) -> StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = StreamReader(BaseProtocol(loop), 2 ** 16, loop=loop)
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    return reader
+
+
+async def measure(read, chunks: list[bytes], rounds: int) -> tuple[float, Response]:
+    result = None
+    elapsed = 0.0
+    for _ in range(rounds):
+        reader = make_reader(chunks)
+        started = time.perf_counter()
+        result = await read(reader)
+        elapsed += time.perf_counter() - started
+    return elapsed / rounds, result
+
+
+async def main(tokens: int, rounds: int) -> None:
+    client = BaseClient("http://localhost")
+    chunks = split_chunks(build_stream(tokens))
+
+    async def current_read(reader: StreamReader) -> Response:
+        return await client._read_stream(SSEDecoder(reader.iter_any()))
+
+    legacy_time, legacy_result = await measure(legacy_read, chunks, rounds)
+    current_time, current_result = await measure(current_read, chunks, rounds)
+    assert legacy_result == current_result, (legacy_result, current_result)
+    print(f"tokens={tokens} rounds={rounds} bytes={sum(map(len, chunks))}")
+    print(f"legacy   {legacy_time * 1000:8.3f} ms/stream")
+    print(f"decoder  {current_time * 1000:8.3f} ms/stream  ({legacy_time / current_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(main(*(args + [5000, 20][len(args):])))
@@ -0,0 +1,130 @@
+"""Offline check and benchmark of the webhook ingress.
+
+Builds the dispatcher of ``start_bot`` against local fakes of Dify and the
+Telegram Bot API, serves it with the webhook routes and delivers updates to
+them like Telegram does. Checks the answers to an accepted update (200), a
+wrong or non-ASCII secret (401), a body that is not a JSON object (400), an unknown
+persona (404) and a burst beyond the intake queue (503), then prints a JSON
+report with the ingest rate. Exits with status 1 when a check fails.
+
+Run with ``python -m benchmarks.bench_webhook --burst 200 --queue-size 20``.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_e2e import build_update
+from benchmarks.fakes import FakeDify, FakeTelegram, FakeWebhookSender, serve
+
+SECRET = "bench-secret"
+
+
+async def run(args: argparse.Namespace) -> dict:
+    dify = FakeDify(first_byte_latency=args.dify_latency)
+    telegram = FakeTelegram()
+    dify_runner, dify_url = await serve(dify.app())
+    telegram_runner, telegram_url = await serve(telegram.app())
+
+    # the configuration is read when src is imported
+    os.environ.update({
+        "DIFY_API_KEY": "bench", "DIFY_BASE_URL": dify_url,
+        "NEWS_API_KEY": "bench", "NEWS_BASE_URL": dify_url,
+        "MAEVE_DIFY_API_KEY": "bench", "TG_GROUP_ID": "", "WEBHOOK_URL": "", "CONVERSATION_DB_PATH": "",
+        "UPDATE_OFFSETS_PATH": os.path.join(tempfile.mkdtemp(), "offsets.json"),
+    })
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    from src.bot.__main__ import create_dispatcher, served_bots
+    from src.bot.webhook import create_webhook_app
+    from src.configuration import WebhookConfig
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(telegram_url))
+    bots = [Bot(token=f"{100 + i}:bench", session=session, default=DefaultBotProperties(parse_mode="MarkdownV2"))
+            for i in range(3)]
+    dispatcher = create_dispatcher(*bots)
+    served = served_bots(*bots)
+    config = WebhookConfig(path="/webhook", secret=SECRET, queue_size=args.queue_size, workers=args.workers)
+    webhook_runner, webhook_url = await serve(create_webhook_app(dispatcher, served, config))
+    await dispatcher.emit_startup(bot=bots[0], dispatcher=dispatcher, bots=bots)
+    sender = FakeWebhookSender(webhook_url + config.path, secret=SECRET)
+
+    rnd = random.Random(args.seed)
+    update_ids = iter(range(1, 10 ** 9))
+
+    def private() -> dict:
+        return build_update(next(update_ids), "private", rnd, 1, "")
+
+    checks: dict[str, bool] = {}
+    # an accepted update is answered
+    update = private()
+    chat_id = update["message"]["chat"]["id"]
+    checks["accepted_200"] = await sender.post(update) == 200
+    deadline = time.perf_counter() + args.dify_latency + 5
+    while not telegram.sent.get(chat_id) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    checks["accepted_answered"] = bool(telegram.sent.get(chat_id))
+    checks["persona_200"] = await sender.post(private(), path="/maeve") == 200
+
+    checks["wrong_secret_401"] = await sender.post(private(), secret="wrong") == 401
+    checks["non_ascii_secret_401"] = await sender.post(private(), secret="sécret") == 401
+    anonymous = FakeWebhookSender(sender.url)
+    checks["missing_secret_401"] = await anonymous.post(private()) == 401
+    await anonymous.close()
+    checks["not_json_400"] = await sender.post(b"{not json") == 400
+    checks["not_object_400"] = all([await sender.post(body) == 400 for body in (b"[]", b"1", b'"x"')])
+    checks["unknown_persona_404"] = await sender.post(private(), path="/nobody") == 404
+
+    # a burst beyond what the workers drain while Dify answers fills the intake queue
+    started = time.perf_counter()
+    burst = await asyncio.gather(*(sender.post(private()) for _ in range(args.burst)))
+    duration = time.perf_counter() - started
+    checks["burst_503"] = 503 in burst and 200 in burst
+
+    await sender.close()
+    await webhook_runner.cleanup()  # cancels the queued updates
+    await dispatcher.emit_shutdown(bot=bots[0], dispatcher=dispatcher, bots=bots)
+    await session.close()
+    await dify_runner.cleanup()
+    await telegram_runner.cleanup()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": vars(args),
+        "checks": checks,
+        "ok": all(checks.values()),
+        "burst": {status: burst.count(status) for status in sorted(set(burst))},
+        "ingest_per_s": round(len(burst) / duration, 2),
+        "statuses": dict(sender.statuses),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--burst", type=int, default=200, help="updates delivered at once after the checks")
+    parser.add_argument("--queue-size", type=int, default=20, help="WEBHOOK_QUEUE_SIZE of the ingress")
+    parser.add_argument("--workers", type=int, default=2, help="WEBHOOK_WORKERS of the ingress")
+    parser.add_argument("--dify-latency", type=float, default=0.5, help="Dify first byte latency in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
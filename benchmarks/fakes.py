@@ -0,0 +1,151 @@
+"""Local stand-ins for the Dify API and the Telegram Bot API used by the benchmarks."""
+import asyncio
+import itertools
+import json
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession, web
+
+
+class FakeDify:
+    """Streams chat-messages and workflow answers with a configurable latency and token rate."""
+
+    def __init__(self, first_byte_latency: float = 0.3, token_rate: float = 50, answer_tokens: int = 40,
+                 need_response: bool = True) -> None:
+        self.first_byte_latency = first_byte_latency
+        self.token_rate = token_rate
+        self.answer_tokens = answer_tokens
+        self.need_response = need_response
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self._conversations = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat-messages", self.chat_messages)
+        app.router.add_post("/v1/workflows/run", self.workflow)
+        return app
+
+    async def _stream(self, request: web.Request, events) -> web.StreamResponse:
+        self.requests += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await asyncio.sleep(self.first_byte_latency)
+            delay = 1 / self.token_rate if self.token_rate else 0
+            for event in events:
+                await response.write(b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n\n")
+                if delay and event.get("event") in ("message", "agent_message"):
+                    await asyncio.sleep(delay)
+            await response.write_eof()
+            return response
+        except ConnectionResetError:
+            return response  # the client closed the stream early, or the run is shutting down
+        finally:
+            self.active -= 1
+
+    def _tokens(self, text: str) -> list[str]:
+        size = max(1, len(text) // self.answer_tokens)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def chat_messages(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        conversation_id = body.get("conversation_id") or f"conversation-{next(self._conversations)}"
+        message = f"收到：{body.get('query', '')[:50]}。" + "这是一个用于压测的回答，包含 *格式* 和 [链接](https://example.com)。" * 3
+        answer = json.dumps({"need_response": self.need_response, "message": message}, ensure_ascii=False)
+        events = [{"event": "message", "conversation_id": conversation_id, "answer": token}
+                  for token in self._tokens(answer)]
+        events.append({"event": "message_end", "conversation_id": conversation_id})
+        return await self._stream(request, events)
+
+    async def workflow(self, request: web.Request) -> web.StreamResponse:
+        news = "**今日新闻**\n" + "某公司发布了新产品，价格为 $99.99 (限时!)\n" * 20
+        events = [{"event": "workflow_started"},
+                  {"event": "workflow_finished", "data": {"outputs": {"today_news": news}}}]
+        return await self._stream(request, events)
+
+
+class FakeTelegram:
+    """Answers Bot API calls like Telegram would and records when each chat got a message."""
+
+    def __init__(self, latency: float = 0.02) -> None:
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+        self.sent: dict[int, list[float]] = defaultdict(list)
+        self._message_ids = itertools.count(1)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    @staticmethod
+    def bot_id(token: str) -> int:
+        return int(token.split(":")[0])
+
+    def _message(self, chat_id: int, text: str) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        token = request.match_info["token"]
+        self.calls[method] += 1
+        data = await request.post()
+        await asyncio.sleep(self.latency)
+        if method == "getme":
+            result = {"id": self.bot_id(token), "is_bot": True, "first_name": "bench", "username": f"bench_{self.bot_id(token)}_bot"}
+        elif method in ("sendmessage", "editmessagetext"):
+            chat_id = int(data["chat_id"])
+            self.sent[chat_id].append(time.perf_counter())
+            result = self._message(chat_id, data.get("text", ""))
+        elif method == "getupdates":
+            await asyncio.sleep(float(data.get("timeout", 0)))
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeWebhookSender:
+    """Delivers updates to a webhook like Telegram does: a POST of the JSON update with the secret token header."""
+
+    def __init__(self, url: str, secret: str | None = None) -> None:
+        self.url = url
+        self.secret = secret
+        self.statuses: dict[int, int] = defaultdict(int)
+        self._session: ClientSession | None = None
+
+    async def post(self, body: dict | bytes, path: str = "", secret: str | None = None) -> int:
+        """Deliver ``body`` (an update, or raw bytes) to ``path`` and return the response status."""
+        if self._session is None:
+            self._session = ClientSession()
+        secret = self.secret if secret is None else secret
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+        async with self._session.post(self.url + path, data=data, headers=headers) as response:
+            self.statuses[response.status] += 1
+            return response.status
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+async def serve(app: web.Application) -> tuple[web.AppRunner, str]:
+    """Start ``app`` on a free local port and return its runner and base URL."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
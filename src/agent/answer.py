@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import json
+import re
+
+_KEY = re.compile(r'[\s{,]*"((?:[^"\\]|\\.)*)"\s*:\s*', re.DOTALL)
+_SPACES = re.compile(r"\s*")
+_BOOLEAN = re.compile(r"true|false")
+_STRING_PART = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+# an escape cut by the end of the text, or a high surrogate waiting for its pair
+_INCOMPLETE_ESCAPE = re.compile(r'\\(?:u[0-9a-fA-F]{0,3})?$|\\u[dD][89abAB][0-9a-fA-F]{2}$')
+_DECODER = json.JSONDecoder()
+
+
+class AnswerParser:
+    """Reads the agent answer, a JSON object with ``need_response`` and ``message``, while it streams.
+
+    Text is fed as it arrives and only the new part is scanned. ``need_response``
+    is known as soon as its value arrived, ``message`` grows with the decoded
+    part of the string received so far. Other keys are skipped.
+    """
+
+    def __init__(self) -> None:
+        self._text = ""
+        self._position = 0
+        self._key: str | None = None  # key whose value is being read
+        self._in_message = False
+        self.need_response: bool | None = None
+        self.message = ""
+        self.message_complete = False
+
+    def feed(self, text: str) -> bool:
+        """Add the next part of the answer, return whether the message grew."""
+        self._text += text
+        grew = False
+        while self._position < len(self._text):
+            if self._in_message:
+                grew |= self._read_message()
+                if self._in_message:
+                    break
+            elif self._key is None:
+                match = _KEY.match(self._text, self._position)
+                if match is None:
+                    break
+                self._key = match.group(1)
+                self._position = match.end()
+            elif not self._read_value():
+                break
+        # the scanned text is not needed anymore
+        self._text = self._text[self._position:]
+        self._position = 0
+        return grew
+
+    def _read_value(self) -> bool:
+        key, text = self._key, self._text
+        position = self._position = _SPACES.match(text, self._position).end()
+        if key == "message" and text.startswith('"', position):
+            self._position += 1
+            self._in_message = True
+            self._key = None
+            return True
+        if key == "need_response":
+            match = _BOOLEAN.match(text, position)
+            if match is not None:
+                self.need_response = match.group() == "true"
+                self._position = match.end()
+                self._key = None
+                return True
+        try:
+            _, self._position = _DECODER.raw_decode(text, position)
+        except ValueError:
+            # not complete yet, or not JSON at all: the caller decodes the whole answer at the end
+            return False
+        self._key = None
+        return True
+
+    def _read_message(self) -> bool:
+        match = _STRING_PART.match(self._text, self._position)
+        part = match.group()
+        closed = self._text.startswith('"', match.end())
+        while not closed and (incomplete := _INCOMPLETE_ESCAPE.search(part)):
+            part = part[:incomplete.start()]
+        self._position += len(part) + closed
+        if closed:
+            self._in_message = False
+            self.message_complete = True
+        if not part:
+            return False
+        try:
+            self.message += json.loads(f'"{part}"')
+        except ValueError:
+            self.message += part
+        return True
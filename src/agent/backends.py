@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING
+
+from yarl import URL
+
+from src.agent.resilience import CircuitBreaker
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+BACKEND_ROUTES = registry.counter(
+    "dify_backend_routes_total", "Requests by Dify backend and routing decision.", ("client", "backend", "route")
+)
+BACKEND_LATENCY = registry.gauge(
+    "dify_backend_first_byte_seconds", "Moving average of the first byte latency of each Dify backend.",
+    ("client", "backend"),
+)
+BACKEND_STATE = registry.gauge(
+    "dify_backend_circuit_state", "Circuit breaker state of each Dify backend.", ("client", "backend")
+)
+
+# separates the backend from the Dify conversation id in stored ids, Dify ids are UUIDs
+_SEPARATOR = ":"
+
+
+class Backend:
+    """One Dify instance, with its own API key, circuit breaker and latency average."""
+
+    def __init__(self, base_url: str | URL, api_key: str | None = None, breaker: CircuitBreaker | None = None) -> None:
+        self.base_url = URL(base_url)
+        self.api_key = api_key
+        self.breaker = breaker if breaker is not None else CircuitBreaker(failure_threshold=0)
+        # stable across restarts and config reordering, prefixes the conversations created on it
+        self.key = hashlib.blake2b(str(self.base_url).encode(), digest_size=4).hexdigest()
+        self.latency: float | None = None
+
+    def __repr__(self) -> str:
+        return f"Backend({str(self.base_url)!r})"
+
+    def observe(self, first_byte: float, alpha: float) -> None:
+        self.latency = first_byte if self.latency is None else alpha * first_byte + (1 - alpha) * self.latency
+
+
+class BackendPool:
+    """Chooses the Dify backend of each request.
+
+    New conversations go to the available backend with the lowest moving
+    average of the first byte latency (backends without samples first), a
+    backend whose open circuit is due for a probe gets the next one. Dify
+    conversations only exist on the backend that created them, so with more
+    than one backend conversation ids are returned prefixed with the key of
+    their backend and requests continuing them are routed back to it.
+    """
+
+    def __init__(self, backends: Iterable[Backend], client_name: str = "Dify", alpha: float = 0.2) -> None:
+        self.backends = list(backends)
+        if not self.backends:
+            raise ValueError("At least one backend is needed")
+        self._by_key = {backend.key: backend for backend in self.backends}
+        self._alpha = alpha
+        self._client_name = client_name
+        self.log = logging.getLogger(self.__class__.__name__)
+        for backend in self.backends:
+            label = str(backend.base_url)
+            BACKEND_LATENCY.labels(client_name, label).set_function(lambda backend=backend: backend.latency or 0)
+            BACKEND_STATE.labels(client_name, label).set_function(lambda backend=backend: backend.breaker.state)
+
+    @property
+    def state(self) -> int:
+        """The state of the healthiest backend, the client is only unavailable when all circuits are open."""
+        return min(backend.breaker.state for backend in self.backends)
+
+    def _count(self, backend: Backend, route: str) -> None:
+        BACKEND_ROUTES.labels(self._client_name, str(backend.base_url), route).inc()
+
+    def pick(self) -> Backend:
+        """Backend for a request that doesn't continue a conversation."""
+        if len(self.backends) == 1:
+            return self.backends[0]
+        for backend in self.backends:
+            if backend.breaker.probe_due():
+                self._count(backend, "probe")
+                return backend
+        available = [backend for backend in self.backends if backend.breaker.available()] or self.backends
+        backend = min(available, key=lambda backend: backend.latency or 0.0)
+        self._count(backend, "fastest")
+        return backend
+
+    def route(self, conversation_id: str | None) -> tuple[Backend, str | None]:
+        """Backend for a request and the conversation id to send to it."""
+        if not conversation_id:
+            return self.pick(), conversation_id
+        if len(self.backends) == 1:
+            return self.backends[0], conversation_id
+        key, separator, local_id = conversation_id.partition(_SEPARATOR)
+        if not separator:
+            # created before there were several backends, on the first one
+            backend = self.backends[0]
+            self._count(backend, "sticky")
+            return backend, conversation_id
+        backend = self._by_key.get(key)
+        if backend is None:
+            self.log.warning("Backend %s of conversation %s is gone, starting a new conversation", key, local_id)
+            return self.pick(), None
+        self._count(backend, "sticky")
+        return backend, local_id
+
+    def conversation_id(self, backend: Backend, local_id: str | None) -> str | None:
+        """The conversation id to store for ``local_id`` created on ``backend``."""
+        if not local_id or len(self.backends) == 1:
+            return local_id
+        return f"{backend.key}{_SEPARATOR}{local_id}"
+
+    def observe(self, backend: Backend, first_byte: float) -> None:
+        backend.observe(first_byte, self._alpha)
@@ -1,20 +1,26 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
-import ssl
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
 from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any
 
 import backoff
-from aiohttp import ClientError, ClientSession, TCPConnector, FormData
-from ujson import dumps
+from aiohttp import ClientError, ClientSession, FormData
+from ujson import loads
+from yarl import URL
 
-if TYPE_CHECKING:
-    from collections.abc import Mapping
+from src.agent.answer import AnswerParser
+from src.agent.backends import Backend, BackendPool
+from src.agent.http import HttpPool
+from src.agent.resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, HedgePolicy, RequestFailed, time_left
+from src.agent.sse import SSEDecoder
+from src.metrics import registry
 
-    from yarl import URL
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Mapping
 
 
 @dataclass
@@ -24,33 +30,80 @@ class Response:
     conversation_id: str
 
 
+class DifyStatusError(ClientError):
+    """Dify answered with a status other than 200."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def client_fault(self) -> bool:
+        """The request itself was rejected, retrying it won't help and Dify is healthy."""
+        return 400 <= self.status < 500 and self.status != 429
+
+
+FIRST_BYTE_SECONDS = registry.histogram(
+    "dify_first_byte_seconds", "Time from sending a request to the first streamed byte.", ("client",)
+)
+STREAM_SECONDS = registry.histogram("dify_stream_seconds", "Total duration of streaming requests.", ("client",))
+RETRIES = registry.counter("dify_retries_total", "Requests retried before the first byte.", ("client",))
+BREAKER_STATE = registry.gauge("dify_circuit_state", "Circuit breaker state: 0 closed, 1 half open, 2 open.",
+                               ("client",))
+BREAKER_REJECTED = registry.counter("dify_circuit_rejected_total", "Requests failed fast by the open circuit.",
+                                    ("client",))
+DEADLINE_EXCEEDED = registry.counter("dify_deadline_exceeded_total", "Requests that ran out of time.", ("client",))
+HEDGED = registry.counter("dify_hedged_total", "Requests that got a hedged second request.", ("client",))
+HEDGE_WINS = registry.counter("dify_hedge_wins_total", "Hedged requests answered first.", ("client",))
+EARLY_ABORTS = registry.counter("dify_early_abort_total", "Streams closed early because no response is needed.",
+                                ("client",))
+
+
+async def _prepend(first: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
 # Taken from here: https://github.com/Olegt0rr/WebServiceTemplate/blob/main/app/core/base_client.py
 class BaseClient:
     """Represents base API client."""
 
-    def __init__(self, base_url: str | URL) -> None:
-        self._base_url = base_url
-        self._session: ClientSession | None = None
+    client_name: str = "BaseClient"  # metrics label
+
+    def __init__(
+            self,
+            base_url: str | URL,
+            pool: HttpPool | None = None,
+            breaker: CircuitBreaker | None = None,
+            hedge: HedgePolicy | None = None,
+            max_retries: int = 2,
+            backends: BackendPool | None = None,
+    ) -> None:
+        # without a shared pool the client owns a private one and closes it in close()
+        self._owns_pool = pool is None
+        self._pool = pool if pool is not None else HttpPool()
+        # ``base_url`` and ``breaker`` describe the only backend unless several are given
+        self._backends = backends if backends is not None else BackendPool(
+            [Backend(base_url, breaker=breaker)], self.client_name)
+        self._hedge = hedge
+        self._max_retries = max_retries
         self.log = logging.getLogger(self.__class__.__name__)
+        self._first_byte_seconds = FIRST_BYTE_SECONDS.labels(self.client_name)
+        self._stream_seconds = STREAM_SECONDS.labels(self.client_name)
+        self._retries = RETRIES.labels(self.client_name)
+        self._rejected = BREAKER_REJECTED.labels(self.client_name)
+        self._deadline_exceeded = DEADLINE_EXCEEDED.labels(self.client_name)
+        self._hedged = HEDGED.labels(self.client_name)
+        self._hedge_wins = HEDGE_WINS.labels(self.client_name)
+        self._early_aborts = EARLY_ABORTS.labels(self.client_name)
+        BREAKER_STATE.labels(self.client_name).set_function(lambda: self._backends.state)
 
     async def _get_session(self) -> ClientSession:
-        """Get aiohttp session with cache."""
-        if self._session is None:
-            ssl_context = ssl.SSLContext()
-            connector = TCPConnector(ssl_context=ssl_context)
-            self._session = ClientSession(
-                base_url=self._base_url,
-                connector=connector,
-                json_serialize=dumps,
-            )
-
-        return self._session
-
-    @backoff.on_exception(
-        backoff.expo,
-        ClientError,
-        max_time=60,
-    )
+        """Get the session of the connection pool."""
+        return self._pool.session()
+
     async def _make_streaming_request(
             self,
             method: str,
@@ -59,9 +112,77 @@ class BaseClient:
             json_data: Mapping[str, str] | None = None,
             headers: Mapping[str, str] | None = None,
             data: FormData | None = None,
-    ) -> Response:
-        """Make request and return decoded json response."""
-        session = await self._get_session()
+            deadline: float | None = None,
+            backend: Backend | None = None,
+    ) -> Any:
+        """Make request and return the result of :meth:`_read_stream`, all of it before ``deadline``."""
+        async with self._open_stream(method, url, params, json_data, headers, data, deadline, backend) as events:
+            try:
+                return await asyncio.wait_for(self._read_stream(events), time_left(deadline))
+            except asyncio.TimeoutError as e:
+                if isinstance(e, ClientError):
+                    raise
+                raise DeadlineExceeded(f"{self.client_name} didn't finish before the deadline") from e
+
+    async def _make_incremental_request(
+            self,
+            method: str,
+            url: str | URL,
+            params: Mapping[str, str] | None = None,
+            json_data: Mapping[str, str] | None = None,
+            headers: Mapping[str, str] | None = None,
+            data: FormData | None = None,
+            deadline: float | None = None,
+            backend: Backend | None = None,
+    ) -> AsyncIterator[Response]:
+        """Make request and yield the response as it is generated.
+
+        ``deadline`` only bounds the wait for the first byte, once the answer
+        streams the user sees it growing.
+        """
+        async with self._open_stream(method, url, params, json_data, headers, data, deadline, backend) as events:
+            async for partial in self._iter_stream(events):
+                yield partial
+
+    def _record_failure(self, breaker: CircuitBreaker, error: BaseException) -> None:
+        if isinstance(error, DifyStatusError) and error.client_fault:
+            breaker.record_success()
+            return
+        if isinstance(error, DeadlineExceeded):
+            self._deadline_exceeded.inc()
+        breaker.record_failure()
+
+    @asynccontextmanager
+    async def _open_stream(
+            self,
+            method: str,
+            url: str | URL,
+            params: Mapping[str, str] | None = None,
+            json_data: Mapping[str, str] | None = None,
+            headers: Mapping[str, str] | None = None,
+            data: FormData | None = None,
+            deadline: float | None = None,
+            backend: Backend | None = None,
+    ) -> AsyncIterator[SSEDecoder]:
+        """Open request once the circuit allows it, check the response status and decode its events.
+
+        The request goes to ``backend``, by default to the one picked by the backend pool.
+        A :class:`ClientError` left after the retries is raised as :class:`RequestFailed`.
+        """
+        backend = backend if backend is not None else self._backends.pick()
+        breaker = backend.breaker
+        try:
+            time_left(deadline)
+        except DeadlineExceeded:
+            self._deadline_exceeded.inc()  # spent waiting locally, Dify was not asked
+            raise
+        if not breaker.allow():
+            self._rejected.inc()
+            raise CircuitOpen(f"{self.client_name} circuit of {backend.base_url} is open")
+        started = time.perf_counter()
+        url = backend.base_url.join(URL(url))
+        if backend.api_key:
+            headers = {**(headers or {}), 'Authorization': f'Bearer {backend.api_key}'}
 
         self.log.debug(
             "Making request %r %r with json %r and params %r",
@@ -70,42 +191,197 @@ class BaseClient:
             json_data,
             params,
         )
-        async with session.request(
+        try:
+            stack, chunks, first_byte = await self._connect(method, url, params, json_data, headers, data, deadline)
+        except ClientError as e:
+            self._record_failure(breaker, e)
+            raise RequestFailed(f"{self.client_name} request to {backend.base_url} failed: {e!r}") from e
+        except DeadlineExceeded as e:
+            if isinstance(e.__cause__, asyncio.TimeoutError):  # a request to Dify timed out
+                self._record_failure(breaker, e)
+            else:
+                self._deadline_exceeded.inc()
+                breaker.release()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        self._backends.observe(backend, first_byte)
+        try:
+            async with stack:
+                yield SSEDecoder(chunks)
+        except ClientError as e:
+            self._record_failure(breaker, e)
+            raise RequestFailed(f"{self.client_name} stream from {backend.base_url} failed: {e!r}") from e
+        except DeadlineExceeded as e:
+            self._record_failure(breaker, e)
+            raise
+        finally:
+            self._stream_seconds.observe(time.perf_counter() - started)
+
+    async def _connect(self, *request: Any) -> tuple[AsyncExitStack, AsyncIterator[bytes], float]:
+        """Wait for the first byte before the deadline (the last item of ``request``), retrying failed attempts.
+
+        Nothing was streamed to the caller yet, so a retry can't duplicate an answer.
+        """
+        *request, deadline = request
+        attempt = 0
+        while True:
+            left = time_left(deadline)  # before creating the coroutine, it would never be awaited
+            try:
+                return await asyncio.wait_for(self._hedged_connect(*request), left)
+            except ClientError as e:
+                if attempt >= self._max_retries or (isinstance(e, DifyStatusError) and e.client_fault):
+                    raise
+                attempt += 1
+                delay = backoff.full_jitter(2 ** attempt)
+                if deadline is not None and delay >= deadline - asyncio.get_running_loop().time():
+                    raise
+                self._retries.inc()
+                self.log.warning("Retrying request in %.1fs after %r", delay, e)
+                await asyncio.sleep(delay)
+            except asyncio.TimeoutError as e:
+                raise DeadlineExceeded(f"{self.client_name} didn't answer before the deadline") from e
+
+    async def _hedged_connect(self, *request: Any) -> tuple[AsyncExitStack, AsyncIterator[bytes], float]:
+        """Connect, and connect again when the first byte is later than the hedge delay; the first to answer wins.
+
+        Requests continuing a conversation are never hedged, Dify would record the turn twice in its history.
+        """
+        json_data = request[3]  # method, url, params, json_data, headers, data
+        delay = self._hedge.delay() if self._hedge is not None else None
+        if delay is None or (json_data and json_data.get("conversation_id")):
+            return await self._connect_once(*request)
+
+        primary = asyncio.create_task(self._connect_once(*request))
+        tasks = {primary}
+        winner: asyncio.Task | None = None
+        error: BaseException | None = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self._hedged.inc()
+                tasks.add(asyncio.create_task(self._connect_once(*request)))
+            while tasks and winner is None:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        await task.result()[0].aclose()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # a loser may have connected right before being cancelled
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[0].aclose()
+        if winner is None:
+            raise error
+        if winner is not primary:
+            self._hedge_wins.inc()
+        return winner.result()
+
+    async def _connect_once(
+            self,
+            method: str,
+            url: URL,
+            params: Mapping[str, str] | None = None,
+            json_data: Mapping[str, str] | None = None,
+            headers: Mapping[str, str] | None = None,
+            data: FormData | None = None,
+    ) -> tuple[AsyncExitStack, AsyncIterator[bytes], float]:
+        """Send the request and wait for the first byte, the stack closes the response.
+
+        Also returns the first byte latency of this attempt, without retries or hedging delays.
+        """
+        session = await self._get_session()
+        started = time.perf_counter()
+        stack = AsyncExitStack()
+        try:
+            response = await stack.enter_async_context(session.request(
                 method, url, params=params, json=json_data, headers=headers, data=data
-        ) as response:
+            ))
             status = response.status
             if status != 200:
                 s = await response.text()
-                raise ClientError(f"Got status {status} for {method} {url}: {s}")
-            message = ""
-            async for line in response.content:
-                if line:
-                    try:
-                        data = json.loads(line.decode("utf-8").replace("data: ", ""))
-                        event_type = data.get("event")
-
-                        if event_type == "message":
-                            message += data.get("answer", "")
-                        elif event_type == "message_end":
-                            message_obj = json.loads(message)
-                            return Response(**message_obj, conversation_id=data.get("conversation_id"))
-                    except json.JSONDecodeError:
-                        continue
-            return Response(need_response=False, message="", conversation_id='')
+                raise DifyStatusError(status, f"Got status {status} for {method} {url}: {s}")
+            chunks = response.content.iter_any()
+            first = await anext(chunks, b"")
+        except BaseException:
+            await stack.aclose()
+            raise
+        first_byte = time.perf_counter() - started
+        self._first_byte_seconds.observe(first_byte)
+        if self._hedge is not None:
+            self._hedge.observe(first_byte)
+        return stack, _prepend(first, chunks), first_byte
 
-    async def close(self) -> None:
-        """Graceful session close."""
-        if not self._session:
-            self.log.debug("There's not session to close.")
-            return
+    async def _read_stream(self, events: SSEDecoder) -> Response:
+        """Collect the agent answer from chat-messages stream events.
 
-        if self._session.closed:
-            self.log.debug("Session already closed.")
-            return
+        The stream is closed as soon as the answer says it needs no response.
+        """
+        answer: list[str] = []
+        parser = AnswerParser()
+        conversation_id = ''
+        async for event in events:
+            event_type = event.get("event")
+
+            if event_type == "message":
+                answer.append(event.get("answer", ""))
+                conversation_id = event.get("conversation_id") or conversation_id
+                if parser.need_response is None:  # the message itself is decoded at the end
+                    parser.feed(answer[-1])
+                if parser.need_response is False:
+                    self._early_aborts.inc()
+                    return Response(need_response=False, message="", conversation_id=conversation_id)
+            elif event_type == "message_end":
+                try:
+                    message_obj = loads("".join(answer))
+                except ValueError:
+                    continue
+                return Response(**message_obj, conversation_id=event.get("conversation_id"))
+        return Response(need_response=False, message="", conversation_id='')
 
-        await self._session.close()
-        self.log.debug("Session successfully closed.")
+    async def _iter_stream(self, events: SSEDecoder) -> AsyncIterator[Response]:
+        """Yield the answer so far each time it grows, the last item is the final response.
 
-        # Wait 250 ms for the underlying SSL connections to close
-        # https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
-        await asyncio.sleep(0.25)
+        Partial items are only yielded once the answer says it needs a response,
+        the stream is closed as soon as it says it doesn't.
+        """
+        answer: list[str] = []
+        parser = AnswerParser()
+        conversation_id = ''
+        yielded = 0
+        async for event in events:
+            event_type = event.get("event")
+
+            if event_type == "message":
+                answer.append(event.get("answer", ""))
+                conversation_id = event.get("conversation_id") or conversation_id
+                parser.feed(answer[-1])
+                if parser.need_response is False:
+                    self._early_aborts.inc()
+                    yield Response(need_response=False, message="", conversation_id=conversation_id)
+                    return
+                message = parser.message
+                if parser.need_response and len(message) > yielded:
+                    yielded = len(message)
+                    yield Response(need_response=True, message=message, conversation_id=conversation_id)
+            elif event_type == "message_end":
+                try:
+                    message_obj = loads("".join(answer))
+                except ValueError:
+                    continue
+                yield Response(**message_obj, conversation_id=event.get("conversation_id"))
+                return
+        yield Response(need_response=False, message="", conversation_id='')
+
+    async def close(self) -> None:
+        """Close the connection pool if the client owns it, a shared pool is closed by its owner."""
+        if self._owns_pool:
+            await self._pool.close()
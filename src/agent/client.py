@@ -1,15 +1,47 @@
 import logging
+from collections.abc import AsyncIterator
+
+from dataclasses import replace
 
 from src.agent.base import BaseClient, Response
+from src.agent.http import HttpPool
 
 logger = logging.getLogger(__name__)
 
 
 class Dify(BaseClient):
-    def __init__(self, api_key: str, base_url: str, **kwargs):
+    client_name = "Dify"
+
+    def __init__(
+            self, api_key: str, base_url: str, pool: HttpPool | None = None, name: str | None = None, **kwargs):
+        if name:
+            self.client_name = name  # metrics label of this app
         self.api_key = api_key
         self.base_url = base_url
-        super().__init__(base_url=self.base_url)
+        super().__init__(base_url=self.base_url, pool=pool, **kwargs)
+
+    def _chat_payload(
+            self,
+            message: str,
+            user_id: int,
+            user_name: str,
+            telegram_chat_type: str,
+            conversation_id: str | None,
+            new_member_name: str | None,
+    ) -> dict:
+        return {
+            "query": message,
+            "response_mode": 'streaming',
+            "conversation_id": conversation_id if conversation_id else '',
+            "user": user_id,
+            "inputs": {
+                "run_type": "chat",
+                "chat_place": "telegram",
+                "user_name": user_name,
+                "new_member_name": new_member_name,
+                "telegram_chat_type": telegram_chat_type,
+            }
+        }
 
     async def send_streaming_chat_message(
             self,
@@ -19,22 +51,41 @@ class Dify(BaseClient):
             telegram_chat_type: str = 'chat',
             conversation_id: str = None,
             new_member_name: str | None = None,
+            deadline: float | None = None,
     ) -> Response:
-        return await self._make_streaming_request(
+        backend, conversation_id = self._backends.route(conversation_id)
+        response = await self._make_streaming_request(
             'post',
             '/v1/chat-messages',
-            json_data={
-                "query": message,
-                "response_mode": 'streaming',
-                "conversation_id": conversation_id if conversation_id else '',
-                "user": user_id,
-                "inputs": {
-                    "run_type": "chat",
-                    "chat_place": "telegram",
-                    "user_name": user_name,
-                    "new_member_name": new_member_name,
-                    "telegram_chat_type": telegram_chat_type,
-                }
-            },
-            headers={'Authorization': f'Bearer {self.api_key}'}
+            json_data=self._chat_payload(
+                message, user_id, user_name, telegram_chat_type, conversation_id, new_member_name
+            ),
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            deadline=deadline,
+            backend=backend,
         )
+        return replace(response, conversation_id=self._backends.conversation_id(backend, response.conversation_id))
+
+    async def stream_chat_message(
+            self,
+            message: str,
+            user_id: int,
+            user_name: str = 'telegram',
+            telegram_chat_type: str = 'chat',
+            conversation_id: str = None,
+            new_member_name: str | None = None,
+            deadline: float | None = None,
+    ) -> AsyncIterator[Response]:
+        """Same as :meth:`send_streaming_chat_message` but yields the answer while it is generated."""
+        backend, conversation_id = self._backends.route(conversation_id)
+        async for response in self._make_incremental_request(
+            'post',
+            '/v1/chat-messages',
+            json_data=self._chat_payload(
+                message, user_id, user_name, telegram_chat_type, conversation_id, new_member_name
+            ),
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            deadline=deadline,
+            backend=backend,
+        ):
+            yield replace(response, conversation_id=self._backends.conversation_id(backend, response.conversation_id))
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import ssl
+from typing import TYPE_CHECKING
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from ujson import dumps
+from yarl import URL
+
+if TYPE_CHECKING:
+    from src.configuration import HttpConfig
+
+
+class HttpPool:
+    """One ``ClientSession`` and connection pool shared by all Dify-style clients.
+
+    The session is created lazily inside the running loop, :meth:`warm_up` opens
+    connections ahead of the first request and :meth:`close` releases them.
+    """
+
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 0,
+            keepalive_timeout: float = 60,
+            dns_cache_ttl: int | None = 300,
+            verify_ssl: bool = True,
+            connect_timeout: float | None = 10,
+    ) -> None:
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._verify_ssl = verify_ssl
+        self._connect_timeout = connect_timeout
+        self._session: ClientSession | None = None
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_config(cls, config: HttpConfig) -> HttpPool:
+        return cls(
+            limit=config.limit,
+            limit_per_host=config.limit_per_host,
+            keepalive_timeout=config.keepalive_timeout,
+            dns_cache_ttl=config.dns_cache_ttl or None,
+            verify_ssl=config.verify_ssl,
+            connect_timeout=config.connect_timeout or None,
+        )
+
+    def _ssl_context(self) -> ssl.SSLContext:
+        if self._verify_ssl:
+            return ssl.create_default_context()
+        # opt-in for a self-hosted Dify behind a self-signed certificate
+        self.log.warning("HTTP_VERIFY_SSL is off, the certificates of Dify are not verified")
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def session(self) -> ClientSession:
+        """Get the shared session, created on first use."""
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+                ttl_dns_cache=self._dns_cache_ttl,
+                use_dns_cache=self._dns_cache_ttl is not None,
+                ssl=self._ssl_context(),
+            )
+            self._session = ClientSession(
+                connector=connector,
+                json_serialize=dumps,
+                timeout=ClientTimeout(total=5 * 60, sock_connect=self._connect_timeout),
+            )
+        return self._session
+
+    async def warm_up(self, *base_urls: str | URL | None, connections: int = 1) -> None:
+        """Resolve and connect to each base URL so the first requests reuse open connections.
+
+        Failures are only logged, the requests will connect again when needed.
+        """
+        session = self.session()
+        origins = {URL(base_url).origin() for base_url in base_urls if base_url}
+
+        async def touch(origin: URL) -> None:
+            try:
+                async with session.head(origin, allow_redirects=False) as response:
+                    await response.read()
+            except (ClientError, OSError, asyncio.TimeoutError) as e:
+                self.log.warning("Failed to warm up connection to %s: %r", origin, e)
+
+        await asyncio.gather(*(touch(origin) for origin in origins for _ in range(connections)))
+        self.log.debug("Warmed up %d connections to %s", connections, ", ".join(map(str, origins)))
+
+    async def close(self) -> None:
+        """Graceful session close."""
+        if self._session is None or self._session.closed:
+            self.log.debug("Session already closed.")
+            return
+
+        await self._session.close()
+        self.log.debug("Session successfully closed.")
+
+        # Wait 250 ms for the underlying SSL connections to close
+        # https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
+        await asyncio.sleep(0.25)
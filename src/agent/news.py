@@ -1,21 +1,17 @@
 from __future__ import annotations
 
-import asyncio
 import json
 import logging
-import ssl
 from dataclasses import dataclass
 from typing import TYPE_CHECKING
 
-import backoff
-from aiogram import loggers
-from aiohttp import ClientError, ClientSession, TCPConnector, FormData
-from ujson import dumps
+from src.agent.base import BaseClient
 
 if TYPE_CHECKING:
-    from collections.abc import Mapping
+    from src.agent.sse import SSEDecoder
+
+logger = logging.getLogger(__name__)
 
-    from yarl import URL
 
 @dataclass
 class Conversations:
@@ -29,91 +25,49 @@ class NewsResponse:
     conversation_id: str
 
 
-# Taken from here: https://github.com/Olegt0rr/WebServiceTemplate/blob/main/app/core/base_client.py
-class NewsClient:
-    """Represents base API client."""
-
-    def __init__(self, base_url: str | URL) -> None:
-        self._base_url = base_url
-        self._session: ClientSession | None = None
-        self.log = logging.getLogger(self.__class__.__name__)
-
-    async def _get_session(self) -> ClientSession:
-        """Get aiohttp session with cache."""
-        if self._session is None:
-            ssl_context = ssl.SSLContext()
-            connector = TCPConnector(ssl_context=ssl_context)
-            self._session = ClientSession(
-                base_url=self._base_url,
-                connector=connector,
-                json_serialize=dumps,
-            )
-
-        return self._session
-
-    @backoff.on_exception(
-        backoff.expo,
-        ClientError,
-        max_time=60,
-    )
-    async def _make_streaming_request(
-            self,
-            method: str,
-            url: str | URL,
-            params: Mapping[str, str] | None = None,
-            json_data: Mapping[str, str] | None = None,
-            headers: Mapping[str, str] | None = None,
-            data: FormData | None = None,
-    ) -> str:
-        """Make request and return decoded json response."""
-        session = await self._get_session()
-
-        self.log.debug(
-            "Making request %r %r with json %r and params %r",
-            method,
-            url,
-            json_data,
-            params,
-        )
-        async with session.request(
-                method, url, params=params, json=json_data, headers=headers, data=data
-        ) as response:
-            status = response.status
-            if status != 200:
-                s = await response.text()
-                raise ClientError(f"Got status {status} for {method} {url}: {s}")
-            message = ""
-            async for line in response.content:
-                if line:
-                    try:
-                        data = json.loads(line.decode("utf-8").replace("data: ", ""))
-                        event_type = data.get("event")
-                        # loggers.dispatcher.info(event_type)
-                        if event_type == "agent_message":
-                            message += data.get("answer", "")
-                        elif event_type == "message_end":
-                            return message
-                        elif event_type == "workflow_finished":
-                            message = data.get("data", {"outputs": {"today_news": ""}}).get("outputs", {"today_news": ""}).get("today_news", "")
-
-                    except json.JSONDecodeError:
-                        continue
-            # return NewsResponse(conversations=[], conversation_id='')
-            return message
-
-    async def close(self) -> None:
-        """Graceful session close."""
-        if not self._session:
-            self.log.debug("There's not session to close.")
-            return
-
-        if self._session.closed:
-            self.log.debug("Session already closed.")
-            return
-
-        await self._session.close()
-        self.log.debug("Session successfully closed.")
-
-        # Wait 250 ms for the underlying SSL connections to close
-        # https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
-        await asyncio.sleep(0.25)
+def parse_conversations(text: str) -> list[Conversations]:
+    """Parse a scripted dialogue returned by the workflow.
+
+    The text is a JSON list of ``{"user", "content", "delayTime"}`` objects, or an
+    object with such a list under ``conversations``, optionally in a code fence.
+    Malformed lines are skipped, an unreadable text gives an empty list.
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        data = json.loads(text)
+    except ValueError:
+        logger.warning("The news workflow did not return a dialogue")
+        return []
+    if isinstance(data, dict):
+        data = data.get("conversations", [])
+    conversations = []
+    for line in data if isinstance(data, list) else []:
+        try:
+            conversations.append(Conversations(
+                user=str(line["user"]).lower(),
+                content=str(line["content"]),
+                delayTime=max(0, int(line.get("delayTime") or 0)),
+            ))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            logger.warning("Skipping malformed dialogue line %r", line)
+    return conversations
+
+
+class NewsClient(BaseClient):
+    """Represents workflow API client, the result is the generated news text."""
+
+    async def _read_stream(self, events: SSEDecoder) -> str:
+        """Collect the news text from workflow stream events."""
+        message: list[str] = []
+        async for event in events:
+            event_type = event.get("event")
+            if event_type == "agent_message":
+                message.append(event.get("answer", ""))
+            elif event_type == "message_end":
+                return "".join(message)
+            elif event_type == "workflow_finished":
+                message = [event.get("data", {"outputs": {"today_news": ""}}).get("outputs", {"today_news": ""}).get("today_news", "")]
+        # return NewsResponse(conversations=[], conversation_id='')
+        return "".join(message)
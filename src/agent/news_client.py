@@ -1,15 +1,18 @@
 import logging
 
+from src.agent.http import HttpPool
 from src.agent.news import NewsClient, NewsResponse
 
 logger = logging.getLogger(__name__)
 
 
 class Dify(NewsClient):
-    def __init__(self, api_key: str, base_url: str, **kwargs):
+    client_name = "NewsDify"
+
+    def __init__(self, api_key: str, base_url: str, pool: HttpPool | None = None, **kwargs):
         self.api_key = api_key
         self.base_url = base_url
-        super().__init__(base_url=self.base_url)
+        super().__init__(base_url=self.base_url, pool=pool, **kwargs)
 
     async def send_streaming_chat_message(
             self,
@@ -19,6 +22,7 @@ class Dify(NewsClient):
             telegram_chat_type: str = 'chat',
             conversation_id: str = None,
             new_member_name: str | None = None,
+            deadline: float | None = None,
     ) -> str:
         return await self._make_streaming_request(
             'post',
@@ -36,5 +40,6 @@ class Dify(NewsClient):
                     "telegram_chat_type": telegram_chat_type,
                 }
             },
-            headers={'Authorization': f'Bearer {self.api_key}'}
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            deadline=deadline,
         )
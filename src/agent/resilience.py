@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import logging
+import math
+import time
+from collections import deque
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.configuration import DifyConfig
+
+
+class DifyUnavailable(Exception):
+    """Dify can't answer in time, callers reply with a canned message instead."""
+
+
+class CircuitOpen(DifyUnavailable):
+    pass
+
+
+class DeadlineExceeded(DifyUnavailable):
+    pass
+
+
+class RequestFailed(DifyUnavailable):
+    """The request failed after its retries, the :class:`aiohttp.ClientError` is the cause."""
+
+
+def deadline_in(seconds: float | None) -> float | None:
+    """Absolute deadline on the loop clock, ``None`` (or 0) for no deadline."""
+    if not seconds:
+        return None
+    return asyncio.get_running_loop().time() + seconds
+
+
+def time_left(deadline: float | None) -> float | None:
+    """Seconds until ``deadline``, raises :class:`DeadlineExceeded` once it passed."""
+    if deadline is None:
+        return None
+    left = deadline - asyncio.get_running_loop().time()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+    return left
+
+
+class BreakerState(enum.IntEnum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and fails fast for ``reset_timeout`` seconds.
+
+    Once the timeout passed a single probe request is let through (half open),
+    its outcome closes or reopens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.state = BreakerState.CLOSED
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_config(cls, config: DifyConfig) -> CircuitBreaker:
+        return cls(failure_threshold=config.breaker_failures, reset_timeout=config.breaker_reset)
+
+    def available(self) -> bool:
+        """Whether :meth:`allow` would let a request through, without taking the probe."""
+        if self.state is BreakerState.CLOSED or self._failure_threshold <= 0:
+            return True
+        if self.state is BreakerState.OPEN and time.monotonic() - self._opened_at < self._reset_timeout:
+            return False
+        return not self._probing
+
+    def probe_due(self) -> bool:
+        """The circuit is not closed and the next request would probe it."""
+        return self.state is not BreakerState.CLOSED and self._failure_threshold > 0 and self.available()
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now, a ``True`` must be followed by a success or a failure."""
+        if self.state is BreakerState.CLOSED or self._failure_threshold <= 0:
+            return True
+        if self.state is BreakerState.OPEN:
+            if time.monotonic() - self._opened_at < self._reset_timeout:
+                return False
+            self.state = BreakerState.HALF_OPEN
+            self.log.info("Circuit half open, probing")
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self._probing = False
+        self._failures = 0
+        if self.state is not BreakerState.CLOSED:
+            self.state = BreakerState.CLOSED
+            self.log.info("Circuit closed")
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self._failures += 1
+        if self.state is BreakerState.HALF_OPEN or (
+                self._failure_threshold > 0 and self._failures >= self._failure_threshold):
+            if self.state is not BreakerState.OPEN:
+                self.log.warning("Circuit opened after %d failures", self._failures)
+            self.state = BreakerState.OPEN
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """The request ended without telling anything about Dify, e.g. it was cancelled."""
+        self._probing = False
+
+
+class HedgePolicy:
+    """Delay after which a second request is sent when the first one has not answered yet.
+
+    The delay is the ``percentile`` of the recent first byte latencies, nothing is
+    hedged until ``min_samples`` latencies were observed.
+    """
+
+    def __init__(self, percentile: float, min_delay: float = 1, window: int = 200, min_samples: int = 20) -> None:
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=window)
+
+    @classmethod
+    def from_config(cls, config: DifyConfig) -> HedgePolicy | None:
+        if not config.hedge_percentile:
+            return None
+        return cls(config.hedge_percentile, min_delay=config.hedge_min_delay)
+
+    def observe(self, first_byte: float) -> None:
+        self._samples.append(first_byte)
+
+    def delay(self) -> float | None:
+        if len(self._samples) < self._min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, math.ceil(self._percentile / 100 * len(ordered)) - 1)
+        return max(self._min_delay, ordered[index])
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING, Any
+
+from ujson import loads
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, AsyncIterator, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class SSEDecoder:
+    """Decodes a server-sent events byte stream into JSON payloads.
+
+    Chunks are framed into lines on a single growing buffer, so events split
+    across network reads are reassembled. Only ``data:`` fields are used, one
+    event is emitted per blank-line terminated block. Payloads that are not
+    valid JSON are skipped.
+
+        async for event in SSEDecoder(response.content.iter_any()):
+            ...
+    """
+
+    def __init__(
+            self,
+            chunks: AsyncIterable[bytes],
+            loads: Callable[[bytes], Any] = loads,
+    ) -> None:
+        self._chunks = chunks
+        self._loads = loads
+
+    def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        return self._events()
+
+    def _decode(self, data: list[bytes]) -> Any:
+        payload = data[0] if len(data) == 1 else b"\n".join(data)
+        try:
+            return self._loads(payload)
+        except ValueError:
+            logger.debug("Skipping undecodable event %r", payload[:100])
+            return None
+
+    async def _events(self) -> AsyncIterator[dict[str, Any]]:
+        buffer = bytearray()
+        data: list[bytes] = []
+        async for chunk in self._chunks:
+            buffer += chunk
+            start = 0
+            while (end := buffer.find(b"\n", start)) != -1:
+                line_end = end - 1 if end > start and buffer[end - 1] == 13 else end  # strip \r
+                if line_end == start:
+                    if data:
+                        event = self._decode(data)
+                        data = []
+                        if event is not None:
+                            yield event
+                elif buffer.startswith(b"data:", start, line_end):
+                    value_start = start + 5
+                    if value_start < line_end and buffer[value_start] == 32:  # optional space
+                        value_start += 1
+                    data.append(bytes(buffer[value_start:line_end]))
+                start = end + 1
+            if start:
+                del buffer[:start]
+
+        if buffer.startswith(b"data:"):
+            value = bytes(buffer[5:]).rstrip(b"\r")
+            data.append(value[1:] if value.startswith(b" ") else value)
+        if data:
+            event = self._decode(data)
+            if event is not None:
+                yield event
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import heapq
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from src.agent.resilience import DeadlineExceeded, time_left
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Hashable, Mapping
+
+
+class PoolOverflow(Exception):
+    """Raised when too many requests are already waiting for the pool."""
+
+
+class PoolDeadlineExceeded(DeadlineExceeded):
+    """Raised when a request is still waiting for the pool at its deadline, Dify was not asked."""
+
+
+class Priority(enum.IntEnum):
+    """Classes of work, lower values are admitted first and shed last."""
+
+    PRIVATE = 0
+    MENTION = 1
+    WELCOME = 2
+    NEWS = 3
+
+
+POOL_REQUESTS = registry.counter(
+    "dify_pool_requests_total", "Dify requests by priority and outcome (admitted, shed, late).", ("priority", "result")
+)
+
+
+@dataclass
+class PoolStats:
+    active: int
+    waiting: int
+    max_waiting: int
+    admitted: int
+    rejected: int
+    wait_time: float  # total seconds spent waiting by admitted requests
+
+
+class WorkerPool:
+    """Limits concurrent agent requests.
+
+    At most ``concurrency`` requests run at once, requests sharing a key (a
+    conversation) run one after another in arrival order. Free slots go to the
+    waiting request of the highest priority, in arrival order within a priority.
+    A priority is shed (its requests fail with :class:`PoolOverflow` instead of
+    queueing) once as many requests as its threshold are already waiting, by
+    default the lowest priority at a quarter of ``max_queue`` up to the highest
+    at ``max_queue``. Requests still waiting at their deadline fail with
+    :class:`PoolDeadlineExceeded` rather than being answered late.
+    """
+
+    def __init__(
+            self,
+            concurrency: int = 8,
+            max_queue: int = 100,
+            shed_thresholds: Mapping[Priority, int] | None = None,
+    ) -> None:
+        self._concurrency = concurrency
+        self._max_queue = max_queue
+        self._shed_thresholds = {
+            priority: max(1, max_queue * (len(Priority) - priority) // len(Priority)) for priority in Priority
+        }
+        self._shed_thresholds.update(shed_thresholds or {})
+        # (priority, sequence, future resolved when the slot is handed over)
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._locks: dict[Hashable, tuple[asyncio.Lock, int]] = {}
+        self._active = 0
+        self._waiting = 0
+        self._max_waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._wait_time = 0.0
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def stats(self) -> PoolStats:
+        return PoolStats(
+            active=self._active,
+            waiting=self._waiting,
+            max_waiting=self._max_waiting,
+            admitted=self._admitted,
+            rejected=self._rejected,
+            wait_time=self._wait_time,
+        )
+
+    def _acquire_lock(self, key: Hashable) -> asyncio.Lock:
+        lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, users + 1)
+        return lock
+
+    def _release_lock(self, key: Hashable) -> None:
+        lock, users = self._locks[key]
+        if users == 1:
+            del self._locks[key]
+        else:
+            self._locks[key] = (lock, users - 1)
+
+    async def _acquire_slot(self, priority: Priority, deadline: float | None) -> None:
+        if self._active < self._concurrency:
+            self._active += 1
+            return
+        entry = (priority, next(self._sequence), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(entry[2], time_left(deadline))
+        except BaseException:
+            if entry[2].done() and not entry[2].cancelled():
+                self._release_slot()  # handed over at the same time, pass it on
+            elif entry in self._waiters:  # already skipped by a release when it was cancelled first
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def _release_slot(self) -> None:
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                # the slot goes straight to the next waiter, ``_active`` is unchanged
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(
+            self,
+            key: Hashable | None = None,
+            priority: Priority = Priority.PRIVATE,
+            deadline: float | None = None,
+    ) -> AsyncIterator[None]:
+        """Wait for a free slot, keyed requests wait for earlier ones with the same key.
+
+        ``deadline`` is on the loop clock (see :func:`deadline_in`).
+        """
+        label = priority.name.lower()
+        if self._waiting >= min(self._max_queue, self._shed_thresholds[priority]):
+            self._rejected += 1
+            POOL_REQUESTS.labels(label, "shed").inc()
+            self.log.warning("Queue is full for %s (%d waiting), rejecting request", label, self._waiting)
+            raise PoolOverflow(f"{self._waiting} requests are already waiting")
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self._waiting += 1
+        self._max_waiting = max(self._max_waiting, self._waiting)
+        waiting = True
+        lock = self._acquire_lock(key) if key is not None else None
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                try:
+                    time_left(deadline)
+                    await self._acquire_slot(priority, deadline)
+                except (DeadlineExceeded, asyncio.TimeoutError):
+                    POOL_REQUESTS.labels(label, "late").inc()
+                    raise PoolDeadlineExceeded("Deadline exceeded while waiting for the pool") from None
+                try:
+                    self._waiting -= 1
+                    waiting = False
+                    self._admitted += 1
+                    self._wait_time += loop.time() - started
+                    POOL_REQUESTS.labels(label, "admitted").inc()
+                    yield
+                finally:
+                    self._release_slot()
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if waiting:
+                self._waiting -= 1
+            if key is not None:
+                self._release_lock(key)
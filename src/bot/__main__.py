@@ -1,221 +1,426 @@
 import asyncio
 import logging
-import random
-import re
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import MessageEntityType
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
-from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, ChatMemberUpdated
+from aiohttp import web
 
+from src.agent.backends import Backend, BackendPool
 from src.agent.client import Dify
+from src.agent.http import HttpPool
 from src.agent.news_client import Dify as NewsDify
+from src.agent.resilience import CircuitBreaker, DifyUnavailable, HedgePolicy, deadline_in
+from src.agent.workers import PoolDeadlineExceeded, PoolOverflow, Priority, WorkerPool
+from src.bot.cache import CacheKey, ResponseCache
+from src.bot.cluster import LeaderLock, run_as_leader, run_front, worker_socket
+from src.bot.conversations import ConversationKey, ConversationStore, conversation_key
+from src.bot.debounce import MessageDebouncer
+from src.bot.dedup import UpdateOffsets
+from src.bot.dialogue import DialoguePlayer
+from src.bot.markdown import escape_markdown_v2, split_markdown_v2
+from src.bot.middlewares import (
+    HANDLER_SECONDS,
+    AddressedFilterMiddleware,
+    DeduplicateMiddleware,
+    HandlerLatencyMiddleware,
+)
+from src.bot.news import NewsPipeline
+from src.bot.personas import MAIN_PERSONA, PERSONAS, Persona
+from src.bot.sender import SendScheduler
+from src.bot.state import JsonStateFile
+from src.bot.streaming import reply_streaming
+from src.bot.webhook import run_webhook
+from src.bot.welcome import MEMBERS_PLACEHOLDER, JoinAggregator, WelcomeTemplate
 from src.configuration import conf
+from src.metrics import registry, start_metrics_server
 
 
-async def start_bot():
-    """启动 bot 并监听消息"""
-    bot_clementine = Bot(token=conf.bot.token, default=DefaultBotProperties(parse_mode='MarkdownV2'))
-    bot_maeve = Bot(token=conf.bot.maeve_token, default=DefaultBotProperties(parse_mode='MarkdownV2'))
-    bot_teddy = Bot(token=conf.bot.teddy_token, default=DefaultBotProperties(parse_mode='MarkdownV2'))
+def create_dispatcher(bot_clementine: Bot, bot_maeve: Bot, bot_teddy: Bot, worker: int | None = None) -> Dispatcher:
+    """创建 Dispatcher 并注册处理器，启动/关闭时的资源管理注册在 startup/shutdown 上
+
+    ``worker`` 是多进程模式下当前 worker 的序号
+    """
     dp = Dispatcher()  # 创建 Dispatcher（消息管理器）
-    dify: Dify = Dify(conf.dify.api_key, conf.dify.base_url)
-    news_client: NewsDify = NewsDify(conf.news.api_key, conf.news.base_url)
+    http_pool = HttpPool.from_config(conf.http)  # Dify 客户端共用一个连接池
+    # 每个回答消息的角色使用自己的 Dify 应用和会话，按收到消息的 bot 区分
+    personas: dict[int, Persona] = {}
+    for name, bot in served_bots(bot_clementine, bot_maeve, bot_teddy).items():
+        main = name == MAIN_PERSONA
+        client_name = "Dify" if main else f"Dify-{name}"
+        # 配置了多个 Dify 实例时，新会话发给最近首字节延迟最低的实例，已有会话留在创建它的实例上
+        backends = BackendPool([
+            Backend(url, api_key, CircuitBreaker.from_config(conf.dify))
+            for url, api_key in PERSONA_BACKENDS[name] or ((conf.dify.base_url, None),)
+        ], client_name)
+        personas[bot.id] = Persona(
+            name,
+            bot,
+            Dify(
+                PERSONA_API_KEYS[name],
+                conf.dify.base_url,
+                pool=http_pool,
+                name=client_name,
+                hedge=HedgePolicy.from_config(conf.dify),
+                max_retries=conf.dify.max_retries,
+                backends=backends,
+            ),
+            ConversationStore.from_config(conf.conversations, persona=None if main else name),
+        )
+    dify = personas[bot_clementine.id].dify  # 欢迎消息由主 bot 生成
+    news_client: NewsDify = NewsDify(
+        conf.news.api_key,
+        conf.news.base_url,
+        pool=http_pool,
+        breaker=CircuitBreaker.from_config(conf.dify),
+        max_retries=conf.dify.max_retries,
+    )
+    # 新会话的第一条消息与历史无关，重复的问题直接使用缓存的回答
+    response_cache = ResponseCache.from_config(conf.response_cache) if conf.response_cache.size else None
+    # 私聊 > @ 提及 > 欢迎 > 新闻，排队过多时先拒绝优先级低的请求
+    dify_pool = WorkerPool(
+        conf.dify.max_concurrency, conf.dify.max_queue, shed_thresholds=dict(zip(Priority, conf.dify.shed_thresholds)))
+    # 所有发往 Telegram 的消息都经过它限速，多进程时各 worker 平分每个 bot 的全局限额
+    sender = SendScheduler.from_config(conf.bot, processes=conf.cluster.workers if worker is not None else 1)
+    # 重启后的轮询和 webhook 重试会重复投递更新，在任何处理器之前丢弃已处理过的更新；
+    # 只有长轮询按顺序收到更新，才保存处理进度：webhook 的更新可能乱序或被 503 后重试，只按最近的 id 去重；
+    # 多进程时由 front 进程保存轮询进度，worker 只在内存中去重
+    polling = worker is None and not conf.webhook.url
+    offsets = UpdateOffsets(JsonStateFile(conf.bot.offsets_path)) if polling else None
+    dp.update.outer_middleware(DeduplicateMiddleware(conf.bot.dedup_capacity, offsets))
+    addressed_filter = AddressedFilterMiddleware()  # 群里没有 @ bot 的消息在这里就被丢弃
+    dp.message.outer_middleware(addressed_filter)
+    dp.message.middleware(HandlerLatencyMiddleware())
+    dp.chat_member.middleware(HandlerLatencyMiddleware())
+    greet_seconds = HANDLER_SECONDS.labels("greet_members")
+    batch_seconds = HANDLER_SECONDS.labels("answer_batch")
+    registry.gauge("conversation_store_size", "Conversations cached in memory.").labels().set_function(
+        lambda: sum(len(persona.conversations) for persona in personas.values()))
+    registry.gauge("dify_pool_active", "Dify requests running.").labels().set_function(
+        lambda: dify_pool.stats().active)
+    registry.gauge("dify_pool_waiting", "Dify requests waiting for a slot.").labels().set_function(
+        lambda: dify_pool.stats().waiting)
+    registry.counter("dify_pool_rejected_total", "Dify requests rejected by a full queue.").labels().set_function(
+        lambda: dify_pool.stats().rejected)
+    registry.counter("dify_pool_wait_seconds_total", "Time Dify requests waited for a slot.").labels().set_function(
+        lambda: dify_pool.stats().wait_time)
+    registry.gauge("telegram_send_pending", "Telegram calls waiting for the rate limit.").labels().set_function(
+        lambda: sender.stats().pending)
+    telegram_sends = registry.counter("telegram_send_total", "Telegram calls by outcome.", ("result",))
+    for result in ("sent", "merged", "retried", "skipped", "failed"):
+        telegram_sends.labels(result).set_function(lambda result=result: getattr(sender.stats(), result))
+
+    async def reply_markdown(message: Message, text: str):
+        """以 MarkdownV2 回复，超过 Telegram 长度限制时拆成多条"""
+        await reply_chunks(message, split_markdown_v2(text))
+
+    async def reply_chunks(message: Message, chunks: list[str]):
+        """回复已经转义并拆分好的 MarkdownV2 文本"""
+        for i, chunk in enumerate(chunks):
+            method = message.reply if i == 0 else message.answer
+            await sender.send(method(chunk, parse_mode="MarkdownV2"))
 
     # 注册命令处理器
     @dp.message(Command("start"))
     async def start_handler(message: Message):
-        await message.answer("你好！我是你的 Bot 🤖")
+        await sender.send(message.answer("你好！我是你的 Bot 🤖"))
 
     @dp.message(Command("help"))
     async def help_handler(message: Message):
-        await message.answer("支持的命令：\n/start - 启动机器人\n/help - 获取帮助")
+        await sender.send(message.answer("支持的命令：\n/start - 启动机器人\n/help - 获取帮助"))
 
-    @dp.message()
-    async def echo_handler(message: Message, state: FSMContext):
-        """监听所有文本消息，并原样返回"""
-        state_data: dict = await state.get_data()
-        chat = message.chat
+    def conversation_of(message: Message) -> tuple[ConversationKey, str]:
+        """私聊按用户、群聊按群和用户区分会话，返回会话 key 和 Dify 的 user"""
         user_id = message.from_user.id
-        result = None
+        if message.chat.type == "private":
+            return conversation_key(user_id), str(user_id)
+        return conversation_key(message.chat.id, user_id), f"{message.chat.id}-{user_id}"
 
-        mention_me = False
-        if chat.type in ["group", "supergroup"]:
-            chat_id = chat.id
+    @dp.message()
+    async def echo_handler(message: Message, addressed: bool, bot: Bot):
+        """回复 @ 了 bot、回复了 bot 的群消息和私聊消息，其他消息已被 AddressedFilterMiddleware 过滤"""
+        if not addressed:  # 群里没有 @ bot 的命令
+            return
+        persona = personas.get(bot.id)
+        if persona is None:
+            return
+        if debouncer is not None:
+            # 连续发送的几条消息合并成一次 Dify 请求
+            debouncer.add((bot.id, conversation_of(message)[0]), message)
+        else:
+            await ask(persona, message, message.text)
 
-            # 检测是否被@提及
-            if message.entities:
-                for entity in message.entities:
-                    if entity.type in [MessageEntityType.MENTION, MessageEntityType.TEXT_MENTION]:
-                        mention_me = True
-                        break
+    async def answer_batch(key: tuple[int, ConversationKey], messages: list[Message]):
+        with batch_seconds.time():
+            await ask(personas[key[0]], messages[-1], "\n".join(message.text for message in messages))
 
-            if mention_me:
-                result = f"{chat_id}-{user_id}"
-            else:
-                result = str(chat_id)
-
-        elif chat.type == "private":
-            result = str(user_id)
-            mention_me = True
-        conversation_id: str | None = None
-        if result:
-            conversation_id = state_data.get(result)
-            user_id = result
-        if message.text is None:
-            return
-        if mention_me:
-            response = await dify.send_streaming_chat_message(
-                message=message.text,
-                user_id=user_id,
-                conversation_id=conversation_id,
-                user_name=message.from_user.username,
+    async def ask(persona: Persona, message: Message, text: str):
+        key, dify_user = conversation_of(message)
+        cache_key = None
+        # 先查回答缓存，命中时不占用 Dify 的并发槽位
+        if response_cache is not None and (not key or await persona.conversations.get(key) is None):
+            cache_key = response_cache.key(text, persona=persona.name)
+            if cache_key and (cached := response_cache.get(cache_key)) is not None:
+                if cached.need_response:
+                    await reply_chunks(message, cached.chunks)
+                return
+        priority = Priority.PRIVATE if message.chat.type == "private" else Priority.MENTION
+        deadline = deadline_in(conf.dify.deadline)  # 排队等待的时间也计算在内，超时的请求不再回答
+        try:
+            async with dify_pool.slot((persona.bot.id, key), priority, deadline):
+                await answer(persona, message, text, key, dify_user, cache_key, deadline)
+        except PoolOverflow:
+            await sender.send(message.reply(escape_markdown_v2(conf.dify.busy_reply), parse_mode="MarkdownV2"))
+        except PoolDeadlineExceeded:
+            # 在本地排队到超时，迟到的回答不再发送；这不是 Dify 的故障
+            logging.warning("Dropping message %s of chat %s, deadline passed in the queue",
+                            message.message_id, message.chat.id)
+        except DifyUnavailable as e:
+            logging.warning("Dify unavailable: %r", e)
+            await sender.send(message.reply(escape_markdown_v2(conf.dify.unavailable_reply), parse_mode="MarkdownV2"))
+
+    async def answer(
+            persona: Persona,
+            message: Message,
+            text: str,
+            key: ConversationKey | None,
+            dify_user: str | int,
+            cache_key: CacheKey | None,
+            deadline: float | None,
+    ):
+        """调用角色的 Dify 应用并回复，同一会话内按顺序执行；``cache_key`` 不为空时缓存新会话的回答"""
+        conversations = persona.conversations
+        # 排队期间同一会话的上一条消息可能已经创建了会话，它的回答不再缓存
+        conversation_id = await conversations.get(key) if key else None
+        if conversation_id is not None:
+            cache_key = None
+        request = dict(
+            message=text,
+            user_id=dify_user,
+            conversation_id=conversation_id,
+            user_name=message.from_user.username,
+            deadline=deadline,
+        )
+        if conf.bot.streaming_reply:
+            # 边生成边编辑回复
+            response = await reply_streaming(
+                message,
+                persona.dify.stream_chat_message(**request),
+                sender,
+                split_markdown_v2,
+                min_interval=conf.bot.streaming_edit_interval,
             )
-            if conversation_id is None:
-                if result and response.conversation_id:
-                    await state.update_data({result: response.conversation_id})  # 存储 UUID
+        else:
+            response = await persona.dify.send_streaming_chat_message(**request)
             if response.need_response:
-                await message.reply(escape_markdown_v2(response.message), parse_mode="MarkdownV2")
+                await reply_markdown(message, response.message)
+        if cache_key and response and response.conversation_id:  # 流提前中断或出错时的空回答不缓存
+            response_cache.put(cache_key, response)
+        if conversation_id is None:
+            if key and response and response.conversation_id:
+                conversations.set(key, response.conversation_id)  # 存储 UUID
 
     @dp.chat_member()
-    async def welcome_handler(event: ChatMemberUpdated):
-        """当有新成员加入时，@他并发送欢迎消息"""
+    async def welcome_handler(event: ChatMemberUpdated, bot: Bot):
+        """当有新成员加入时，@他并发送欢迎消息（短时间内的加入合并成一条）"""
+        if bot.id != bot_clementine.id:  # 其他角色也是管理员时只由主 bot 欢迎
+            return
         if event.new_chat_member.status in ["member", "restricted"]:  # 只欢迎新成员
-            member_name = event.new_chat_member.user.username or event.new_chat_member.user.first_name or "New Member"
-            new_member_name = f"@{member_name}"
+            joins.add(event.chat.id, event)
+
+    async def greet_members(chat_id: int, events: list[ChatMemberUpdated]):
+        """为一批新成员生成一条欢迎消息，人数过多或 Dify 繁忙时使用预生成的模板"""
+        with greet_seconds.time():
+            names = [
+                event.new_chat_member.user.username or event.new_chat_member.user.first_name or "New Member"
+                for event in events
+            ]
+            mentions = ", ".join(f"@{name}" for name in names[:conf.welcome.max_mentions])
+            if len(names) > conf.welcome.max_mentions:
+                mentions += f" +{len(names) - conf.welcome.max_mentions}"
+            text = None
+            if len(names) <= conf.welcome.burst_threshold:
+                deadline = deadline_in(conf.welcome.deadline)
+                try:
+                    async with dify_pool.slot(priority=Priority.WELCOME, deadline=deadline):
+                        response = await dify.send_streaming_chat_message(
+                            message="new member join the group",
+                            user_id=events[0].from_user.id,
+                            conversation_id=None,
+                            new_member_name=mentions,
+                            user_name=", ".join(names),
+                            telegram_chat_type="welcome",
+                            deadline=deadline,
+                        )
+                    text = response.message if response.need_response else None
+                except (PoolOverflow, DifyUnavailable):
+                    text = welcome_template.render(mentions)
+            else:
+                text = welcome_template.render(mentions)
+            welcome_template.refresh(generate_welcome_template)
+            if text:
+                for chunk in split_markdown_v2(text):
+                    await sender.send(events[-1].answer(chunk, parse_mode="MarkdownV2"))
+
+    async def generate_welcome_template() -> str | None:
+        async with dify_pool.slot(priority=Priority.WELCOME):
             response = await dify.send_streaming_chat_message(
                 message="new member join the group",
-                user_id=event.from_user.id,
+                user_id="welcome",
                 conversation_id=None,
-                new_member_name=new_member_name,
-                user_name=member_name,
+                new_member_name=MEMBERS_PLACEHOLDER,
+                user_name=MEMBERS_PLACEHOLDER,
                 telegram_chat_type="welcome",
             )
-            if response.need_response:
-                await event.answer(escape_markdown_v2(response.message), parse_mode="MarkdownV2")
-
-    # async def send_daily_random_messages():
-    #     while True:
-    #         if conf.bot.tg_group_id:
-    #             response = await news_client.send_streaming_chat_message(
-    #                 message="get today news.",
-    #                 user_id=conf.bot.tg_group_id,
-    #                 conversation_id=None,
-    #                 new_member_name=None,
-    #                 telegram_chat_type="ask_for_news",
-    #             )
-    #             for conversation in response.conversations:
-    #                 # sleep conversation.delayTime seconds
-    #                 await asyncio.sleep(conversation.delayTime)
-    #                 if conversation.user == "maeve":
-    #                     # use telegram bot api to send message
-    #                     await bot_maeve.send_message(
-    #                         text=escape_markdown_v2(conversation.content),
-    #                         chat_id=conf.bot.tg_group_id,
-    #                         parse_mode="MarkdownV2",
-    #                         reply_to_message_id=481
-    #                     )
-    #                 elif conversation.user == "teddy":
-    #                     await bot_teddy.send_message(
-    #                         text=escape_markdown_v2(conversation.content),
-    #                         chat_id=conf.bot.tg_group_id,
-    #                         parse_mode="MarkdownV2",
-    #                         reply_to_message_id=481
-    #                     )
-    #                 elif conversation.user == "clementine":
-    #                     await bot_clementine.send_message(
-    #                         text=escape_markdown_v2(conversation.content),
-    #                         chat_id=conf.bot.tg_group_id,
-    #                         parse_mode="MarkdownV2",
-    #                         reply_to_message_id=481
-    #                     )
-    #         await asyncio.sleep(random.randint(60 * 60 * 8, 60 * 60 * 14))  # Sleep for a random 5-6 hours
-
-    async def send_daily_random_messages():
-        while True:
-            if conf.bot.tg_group_id:
-                response = await news_client.send_streaming_chat_message(
-                    message="get today news.",
-                    user_id=conf.bot.tg_group_id,
-                    conversation_id=None,
-                    new_member_name=None,
-                    telegram_chat_type="ask_for_news",
-                )
-                await bot_clementine.send_message(text=escape_markdown_v2(response),
-                                       parse_mode="MarkdownV2",chat_id=conf.bot.tg_group_id)
-                await asyncio.sleep(random.randint(60 * 60 * 10, 60 * 60 * 18))  # Sleep for a random 5-6 hours
-
-    asyncio.create_task(send_daily_random_messages())
-    # 启动 bot
-    await dp.start_polling(bot_clementine)
-
-
-def escape_markdown_v2(text: str) -> str:
-    """
-    保留 MarkdownV2 结构（链接、粗体等），转义其他部分的保留字符
-    """
-    # 匹配 MarkdownV2 的核心结构（非贪婪匹配，优先处理链接）
-    pattern = re.compile(
-        r'(\[.*?\]\(\S*?\))'  # 链接 [text](url)，URL中不允许空格
-        r'|(\*\*.*?\*\*)'  # 粗体 **text**
-        r'|(\*.*?\*)'  # 斜体 *text*
-        r'|(__.*?__)'  # 下划线 __text__
-        r'|(_.*?_)'  # 斜体 _text_
-        r'|(`.*?`)'  # 行内代码 `text`
-        r'|(```[\s\S]*?```)'  # 多行代码块
-        r'|\\n'  # 换行
-        , re.DOTALL)
-
-    parts = []
-    last_end = 0
-
-    for match in pattern.finditer(text):
-        start = match.start()
-        end = match.end()
-
-        # 转义非结构化的普通文本
-        if start > last_end:
-            plain_text = text[last_end:start]
-            parts.append(_escape_plain_text(plain_text))
-        group_text = match.group()
-        if match := re.match(r'\[(.*?)\]\((\S*?)\)', group_text, re.DOTALL):
-            link_text = match.group(1)
-            link_url = match.group(2)
-            parts.append(f'[{_escape_plain_text(link_text)}]({_escape_plain_text(link_url)})')
-        elif match := re.match(r'\*\*(.*?)\*\*', group_text, re.DOTALL):
-            txt = match.group(1)
-            parts.append(f'**{_escape_plain_text(txt)}**')
-        elif match := re.match(r'__(.*?)__', group_text, re.DOTALL):
-            txt = match.group(1)
-            parts.append(f'__{_escape_plain_text(txt)}__')
-        elif match := re.match(r'_(.*?)_', group_text):
-            txt = match.group(1)
-            parts.append(f'_{_escape_plain_text(txt)}_')
-        elif match := re.match(r'`(.*?)`', group_text):
-            txt = match.group(1)
-            parts.append(f'`{_escape_plain_text(txt)}`')
-        elif match := re.match(r'```([\s\S]*?)```', group_text):
-            txt = match.group(1)
-            parts.append(f'```{_escape_plain_text(txt)}```')
-        elif re.match(r'\\n', group_text):
-            parts.append(f'\n')
+        return response.message if response.need_response else None
+
+    debouncer: MessageDebouncer[Message] | None = MessageDebouncer(
+        answer_batch, window=conf.bot.debounce_window, max_wait=conf.bot.debounce_max_wait,
+    ) if conf.bot.debounce_window else None
+    joins: JoinAggregator[ChatMemberUpdated] = JoinAggregator(greet_members, window=conf.welcome.batch_window)
+    welcome_template = WelcomeTemplate(
+        conf.welcome.default_template,
+        ttl=conf.welcome.template_ttl,
+        retry_interval=conf.welcome.template_retry_interval,
+    )
+
+    async def generate_news() -> str:
+        # 新闻提前生成，优先级最低，来不及生成时由 NewsPipeline 稍后重试
+        deadline = deadline_in(conf.news.prefetch_lead)
+        async with dify_pool.slot(priority=Priority.NEWS, deadline=deadline):
+            return await news_client.send_streaming_chat_message(
+                message="get today news.",
+                user_id=conf.news.groups[0],
+                conversation_id=None,
+                new_member_name=None,
+                telegram_chat_type="ask_for_news",
+                deadline=deadline,
+            )
+
+    # 对话模式下每句由对应角色的 bot 按 delayTime 依次发送，未发送的句子保存在文件里
+    player = DialoguePlayer(
+        dict(zip(PERSONAS, (bot_clementine, bot_maeve, bot_teddy))),
+        sender,
+        JsonStateFile(conf.news.dialogue_state_path),
+        default=MAIN_PERSONA,
+    ) if conf.news.dialogue else None
+    # 新闻在发送时间之前生成，同一份内容发到所有群，发送进度保存在文件里，重启后不会重复发送
+    news = NewsPipeline.from_config(
+        conf.news, generate_news, sender, bot_clementine, JsonStateFile(conf.news.state_path), player=player)
+
+    async def run_news():
+        if player is None:
+            await news.run()
         else:
-            parts.append(group_text)
-        last_end = end
+            await player.load()  # 新闻可能立刻调用 play()，先恢复未播放的对话
+            await asyncio.gather(news.run(), player.run())
+
+    background_tasks: list[asyncio.Task] = []
+    metrics_runners: list[web.AppRunner] = []
+
+    @dp.startup()
+    async def on_startup():
+        for persona in personas.values():
+            await addressed_filter.load(persona.bot)  # 缓存 bot 的 username/id
+            await persona.conversations.start()
+        if offsets is not None:
+            await offsets.load()
+            for persona in personas.values():
+                await offsets.confirm(persona.bot)  # 长轮询从上次处理到的位置继续
+            background_tasks.append(asyncio.create_task(offsets.run(conf.bot.offsets_save_interval)))
+        await http_pool.warm_up(
+            conf.dify.base_url,
+            conf.news.base_url,
+            *(url for backends in PERSONA_BACKENDS.values() for url, _ in backends),
+            connections=conf.http.warmup_connections,
+        )
+        if conf.metrics.port:
+            metrics_port = conf.metrics.port + (worker or 0)  # 每个 worker 使用自己的端口
+            metrics_runners.append(await start_metrics_server(conf.metrics.host, metrics_port, conf.metrics.path))
+        welcome_template.refresh(generate_welcome_template)  # 预先生成加入高峰时使用的欢迎模板
+        if conf.news.groups:
+            # 同一台机器上只有持有锁的进程发送新闻
+            background_tasks.append(asyncio.create_task(run_as_leader(
+                LeaderLock(conf.cluster.leader_lock), run_news, retry=conf.cluster.leader_retry)))
+
+    @dp.shutdown()
+    async def on_shutdown():
+        for task in background_tasks:
+            task.cancel()
+        for persona in personas.values():
+            await persona.conversations.close()
+        if offsets is not None:
+            await offsets.save()
+        await http_pool.close()
+        for runner in metrics_runners:
+            await runner.cleanup()
+
+    if unlisted := set(dp.resolve_used_update_types()) - set(HANDLED_UPDATES):
+        logging.warning("HANDLED_UPDATES is missing %s, the front doesn't receive them", sorted(unlisted))
+    return dp
+
+
+# 处理器使用的更新类型；多进程的 front 只转发更新，不构建 Dispatcher 及其连接池、存储，按它向 Telegram 订阅
+HANDLED_UPDATES = ["message", "chat_member"]
 
-    # 处理剩余文本
-    if last_end < len(text):
-        plain_text = text[last_end:]
-        parts.append(_escape_plain_text(plain_text))
 
-    return ''.join(parts)
+# 每个角色的 Dify 应用
+PERSONA_API_KEYS = dict(zip(PERSONAS, (conf.dify.api_key, conf.dify.maeve_api_key, conf.dify.teddy_api_key)))
+PERSONA_BACKENDS = dict(zip(PERSONAS, (conf.dify.backends, conf.dify.maeve_backends, conf.dify.teddy_backends)))
 
 
-def _escape_plain_text(text: str) -> str:
-    """转义普通文本中的 MarkdownV2 保留字符"""
-    return re.sub(pattern=re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])"), repl=r'\\\1', string=text)
+def create_bots() -> tuple[Bot, Bot, Bot]:
+    """三个 bot 共用一个到 Telegram API 的连接池"""
+    session = AiohttpSession()
+    return (
+        Bot(token=conf.bot.token, session=session, default=DefaultBotProperties(parse_mode='MarkdownV2')),
+        Bot(token=conf.bot.maeve_token, session=session, default=DefaultBotProperties(parse_mode='MarkdownV2')),
+        Bot(token=conf.bot.teddy_token, session=session, default=DefaultBotProperties(parse_mode='MarkdownV2')),
+    )
+
+
+def served_bots(bot_clementine: Bot, bot_maeve: Bot, bot_teddy: Bot) -> dict[str, Bot]:
+    """接收并回答消息的 bot，主 bot 在最前；没有配置 Dify API key 的角色只用来发送新闻对话"""
+    bots = dict(zip(PERSONAS, (bot_clementine, bot_maeve, bot_teddy)))
+    return {
+        name: bot for name, bot in bots.items()
+        if name == MAIN_PERSONA or (conf.bot.serve_personas and PERSONA_API_KEYS[name])
+    }
+
+
+async def serve_worker(index: int):
+    """多进程模式下的 worker：从 front 进程的 unix socket 接收分配给它的会话的更新"""
+    bots = create_bots()
+    dp = create_dispatcher(*bots, worker=index)
+    await run_webhook(dp, served_bots(*bots), conf.webhook, socket_path=worker_socket(conf.cluster, index))
+
+
+def run_worker(index: int):
+    """worker 进程入口"""
+    logging.basicConfig(level=conf.logging_level)
+    asyncio.run(serve_worker(index))
+
+
+async def start_bot():
+    """启动 bot 并监听消息"""
+    bots = create_bots()
+    served = served_bots(*bots)  # 所有角色在同一个进程、同一个 Dispatcher 中接收消息
+    # 启动 bot：配置了 CLUSTER_WORKERS 时由 front 进程把更新按会话分给多个 worker；
+    # 配置了 WEBHOOK_URL 时使用 webhook，否则长轮询
+    if conf.cluster.workers:
+        offsets = UpdateOffsets(JsonStateFile(conf.bot.offsets_path)) if not conf.webhook.url else None
+        await run_front(served, run_worker, conf.cluster, conf.webhook, HANDLED_UPDATES, offsets,
+                        conf.bot.offsets_save_interval)
+        return
+    dp = create_dispatcher(*bots)
+    if conf.webhook.url:
+        await run_webhook(dp, served, conf.webhook)
+    else:
+        for bot in served.values():
+            await bot.delete_webhook()
+        await dp.start_polling(*served.values())
 
 
 if __name__ == "__main__":
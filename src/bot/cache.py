@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from src.bot.markdown import split_markdown_v2
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from src.agent.base import Response
+    from src.configuration import ResponseCacheConfig
+
+RESPONSE_CACHE = registry.counter("response_cache_total", "Response cache lookups by outcome.", ("result",))
+
+_SPACES = re.compile(r"\s+")
+_TRAILING = re.compile(r"[\s?!.,;:~？！。，；：～]+$")
+
+# (persona, telegram_chat_type, normalized query)
+CacheKey = tuple[str, str, str]
+
+
+@dataclass
+class CachedReply:
+    need_response: bool
+    chunks: list[str]  # MarkdownV2, ready to send
+    size: int
+    expires_at: float
+
+
+class ResponseCache:
+    """Answers to the first message of a conversation, keyed by the normalized query.
+
+    Only queries without a conversation are cached, since no history can change
+    their answer. Entries are evicted least recently used first once there are
+    more than ``max_entries`` of them or they take more than ``max_bytes``, and
+    expire ``ttl`` seconds after they were stored.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 1000,
+            max_bytes: int = 4 * 1024 * 1024,
+            ttl: float = 60 * 60,
+            max_query_length: int = 200,
+    ) -> None:
+        self._entries: OrderedDict[CacheKey, CachedReply] = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._max_query_length = max_query_length
+        self._bytes = 0
+        registry.gauge("response_cache_bytes", "Size of the cached responses.").labels().set_function(
+            lambda: self._bytes)
+        registry.gauge("response_cache_entries", "Cached responses.").labels().set_function(
+            lambda: len(self._entries))
+
+    @classmethod
+    def from_config(cls, config: ResponseCacheConfig) -> ResponseCache:
+        return cls(
+            max_entries=config.size,
+            max_bytes=config.max_bytes,
+            ttl=config.ttl,
+            max_query_length=config.max_query_length,
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, query: str, telegram_chat_type: str = "chat", persona: str = "") -> CacheKey | None:
+        """Cache key of ``query`` asked to ``persona``, None when it is too long to be a repeated question.
+
+        The name of the asking user is not part of the key on purpose, so different users share the answer:
+        when the agent addressed the first user by name, the others get that name too.
+        """
+        normalized = _TRAILING.sub("", _SPACES.sub(" ", query).strip().casefold())
+        if not normalized or len(normalized) > self._max_query_length:
+            return None
+        return persona, telegram_chat_type, normalized
+
+    def _drop(self, key: CacheKey) -> None:
+        self._bytes -= self._entries.pop(key).size
+
+    def get(self, key: CacheKey) -> CachedReply | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                RESPONSE_CACHE.labels("hit").inc()
+                return entry
+            self._drop(key)
+        RESPONSE_CACHE.labels("miss").inc()
+        return None
+
+    def put(self, key: CacheKey, response: Response) -> None:
+        chunks = split_markdown_v2(response.message) if response.need_response else []
+        size = len(key[2].encode()) + sum(len(chunk.encode()) for chunk in chunks)
+        if size > self._max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = CachedReply(response.need_response, chunks, size, time.monotonic() + self._ttl)
+        self._bytes += size
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            self._drop(next(iter(self._entries)))
+            RESPONSE_CACHE.labels("evicted").inc()
@@ -0,0 +1,326 @@
+"""Multi-process mode: a front process receives updates and routes them to workers by chat.
+
+All updates of a chat go to the same worker, so the per-conversation ordering,
+caches and per-chat send limits of a worker stay valid. Workers share the
+conversation SQLite file and elect one of them to run the news scheduler with a
+file lock, everything stays on one machine.
+"""
+from __future__ import annotations
+
+import asyncio
+import errno
+import fcntl
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import signal
+from bisect import bisect
+from contextlib import suppress
+from typing import TYPE_CHECKING, Any
+
+from aiohttp import ClientError, ClientSession, UnixConnector, web
+from ujson import loads
+
+from src.bot.webhook import SECRET_HEADER, WORKER_PATH, persona_path, set_webhooks
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Mapping
+
+    from aiogram import Bot
+
+    from src.bot.dedup import UpdateOffsets
+    from src.configuration import ClusterConfig, WebhookConfig
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring, changing the number of nodes only moves the keys of the changed nodes."""
+
+    def __init__(self, nodes: int, replicas: int = 128) -> None:
+        points = sorted((_hash(f"{node}:{replica}"), node) for node in range(nodes) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: int) -> int:
+        index = bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def update_chat_id(update: dict[str, Any]) -> int:
+    """The chat an update belongs to, the user for updates without a chat."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+def worker_socket(config: ClusterConfig, index: int) -> str:
+    return os.path.join(config.socket_dir, f"worker-{index}.sock")
+
+
+class UpdateRouter:
+    """Forwards raw updates to the worker owning their chat.
+
+    Each worker has its own queue drained by one task, so updates reach a
+    worker in the order they were received. While a worker is restarting its
+    updates wait in the queue. Updates of persona bots are forwarded to the
+    persona route of the worker, those of the main bot (``persona=None``) to
+    the route itself.
+    """
+
+    def __init__(self, sockets: list[str], queue_size: int = 1000, retry_for: float = 30) -> None:
+        self._sockets = sockets
+        self._ring = HashRing(len(sockets))
+        self._queues: list[asyncio.Queue[tuple[str | None, dict[str, Any]]]] = [
+            asyncio.Queue(maxsize=queue_size) for _ in sockets
+        ]
+        self._retry_for = retry_for
+        self._sessions: list[ClientSession] = []
+        self._tasks: list[asyncio.Task] = []
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def _queue_for(self, update: dict[str, Any]) -> asyncio.Queue[tuple[str | None, dict[str, Any]]]:
+        return self._queues[self._ring.node_for(update_chat_id(update))]
+
+    def offer(self, update: dict[str, Any], persona: str | None = None) -> bool:
+        """Queue ``update`` without waiting, ``False`` when the worker queue is full."""
+        try:
+            self._queue_for(update).put_nowait((persona, update))
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, update: dict[str, Any], persona: str | None = None) -> None:
+        await self._queue_for(update).put((persona, update))
+
+    async def _forward(self, index: int) -> None:
+        queue = self._queues[index]
+        session = self._sessions[index]
+        loop = asyncio.get_running_loop()
+        while True:
+            persona, update = await queue.get()
+            path = persona_path(WORKER_PATH, persona) if persona else WORKER_PATH
+            give_up_at = loop.time() + self._retry_for
+            while True:
+                try:
+                    async with session.post(f"http://worker{path}", json=update) as response:
+                        if response.status == 200:
+                            break
+                        error: Any = f"status {response.status}"
+                except (ClientError, OSError) as e:
+                    error = e
+                if loop.time() > give_up_at:
+                    self.log.error("Dropping update %s, worker %d failed: %r", update.get("update_id"), index, error)
+                    break
+                await asyncio.sleep(0.5)
+            queue.task_done()
+
+    async def start(self) -> None:
+        self._sessions = [ClientSession(connector=UnixConnector(path=socket)) for socket in self._sockets]
+        self._tasks = [asyncio.create_task(self._forward(index)) for index in range(len(self._sockets))]
+
+    async def close(self, timeout: float = 5) -> None:
+        """Forward the queued updates for up to ``timeout`` seconds, then stop."""
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        for session in self._sessions:
+            await session.close()
+
+
+class LeaderLock:
+    """Non-blocking ``flock`` on a file, held by at most one process of the machine."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._fd: int | None = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+async def run_as_leader(lock: LeaderLock, run: Callable[[], Awaitable[None]], retry: float = 30) -> None:
+    """Run ``run`` while holding ``lock``, the other processes retry every ``retry`` seconds to take over."""
+    log = logging.getLogger(__name__)
+    while True:
+        if lock.try_acquire():
+            log.info("Became leader, pid %d", os.getpid())
+            try:
+                await run()
+            except Exception:
+                log.exception("Leader task failed")
+            finally:
+                lock.release()
+        await asyncio.sleep(retry)
+
+
+class _FrontIngress:
+    """Webhook endpoint of the front process, routes updates instead of handling them."""
+
+    def __init__(self, router: UpdateRouter, secret: str | None, personas: frozenset[str] = frozenset()) -> None:
+        self._router = router
+        self._secret = secret
+        self._personas = personas
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._secret and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, "").encode(), self._secret.encode()
+        ):
+            return web.Response(status=401)
+        persona = request.match_info.get("persona")
+        if persona is not None and persona not in self._personas:
+            return web.Response(status=404)
+        try:
+            update = await request.json(loads=loads)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        if not self._router.offer(update, persona):
+            return web.Response(status=503)
+        return web.Response()
+
+
+async def _poll(
+        bot: Bot,
+        router: UpdateRouter,
+        allowed_updates: list[str],
+        persona: str | None = None,
+        offsets: UpdateOffsets | None = None,
+) -> None:
+    log = logging.getLogger(__name__)
+    offset = offsets.get(bot.id) if offsets is not None else None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception:
+            log.exception("Failed to get updates")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await router.put(update.model_dump(mode="json", exclude_unset=True, by_alias=True), persona)
+            offset = update.update_id + 1
+            if offsets is not None:
+                offsets.done(bot.id, update.update_id)
+
+
+async def run_front(
+        bots: Mapping[str, Bot],
+        worker: Callable[[int], None],
+        config: ClusterConfig,
+        webhook: WebhookConfig,
+        allowed_updates: list[str],
+        offsets: UpdateOffsets | None = None,
+        save_interval: float = 5,
+) -> None:
+    """Start ``config.workers`` processes running ``worker(index)`` and route updates to them until stopped.
+
+    Updates of every bot come from the webhook when ``webhook.url`` is set, otherwise from long polling,
+    which resumes from ``offsets`` after a restart. Workers that exit are restarted.
+    """
+    bot = next(iter(bots.values()))
+    log = logging.getLogger(__name__)
+    os.makedirs(config.socket_dir, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+
+    def spawn(index: int) -> multiprocessing.Process:
+        with suppress(FileNotFoundError):
+            os.unlink(worker_socket(config, index))
+        process = context.Process(target=worker, args=(index,), name=f"worker-{index}")
+        process.start()
+        log.info("Started worker %d, pid %d", index, process.pid)
+        return process
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    processes = [spawn(index) for index in range(config.workers)]
+    router = UpdateRouter([worker_socket(config, index) for index in range(config.workers)],
+                          queue_size=webhook.queue_size)
+    await router.start()
+
+    runner = None
+    sources: list[asyncio.Task] = []
+    if webhook.url:
+        app = web.Application()
+        ingress = _FrontIngress(router, webhook.secret, frozenset(list(bots)[1:]))
+        app.router.add_post(webhook.path, ingress.handle)
+        if len(bots) > 1:
+            app.router.add_post(persona_path(webhook.path, "{persona}"), ingress.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host=webhook.host, port=webhook.port).start()
+        await set_webhooks(bots, webhook, allowed_updates)
+        log.info("Webhook listening on %s:%s%s", webhook.host, webhook.port, webhook.path)
+    else:
+        if offsets is not None:
+            await offsets.load()
+            sources.append(asyncio.create_task(offsets.run(save_interval)))
+        for i, (persona, persona_bot) in enumerate(bots.items()):
+            await persona_bot.delete_webhook()
+            sources.append(asyncio.create_task(
+                _poll(persona_bot, router, allowed_updates, persona if i else None, offsets)))
+
+    async def supervise() -> None:
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    log.warning("Worker %d exited with %s, restarting", index, process.exitcode)
+                    processes[index] = spawn(index)
+
+    supervisor = asyncio.create_task(supervise())
+    try:
+        await stop.wait()
+    finally:
+        supervisor.cancel()
+        for source in sources:
+            source.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        await router.close()
+        if offsets is not None:
+            await offsets.save()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, 10)
+        await bot.session.close()
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from src.configuration import ConversationConfig
+
+# (chat_id, user_id), user_id is 0 for keys shared by the whole chat
+ConversationKey = tuple[int, int]
+
+_MISSING = object()
+
+
+def conversation_key(chat_id: int, user_id: int = 0) -> ConversationKey:
+    """Build the store key of a chat or of a user inside a chat."""
+    return chat_id, user_id
+
+
+class ConversationBackend:
+    """Represents persistent storage behind the conversation store."""
+
+    async def load(self, key: ConversationKey) -> str | None:
+        raise NotImplementedError
+
+    async def save_many(self, items: Iterable[tuple[ConversationKey, str]]) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryBackend(ConversationBackend):
+    """Non persistent backend, conversations are lost on restart."""
+
+    def __init__(self) -> None:
+        self._data: dict[ConversationKey, str] = {}
+
+    async def load(self, key: ConversationKey) -> str | None:
+        return self._data.get(key)
+
+    async def save_many(self, items: Iterable[tuple[ConversationKey, str]]) -> None:
+        self._data.update(items)
+
+
+class SQLiteBackend(ConversationBackend):
+    """SQLite file backend, all queries run on a single dedicated thread."""
+
+    def __init__(self, path: str, table: str = "conversations") -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversations")
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " chat_id INTEGER NOT NULL,"
+            " user_id INTEGER NOT NULL,"
+            " conversation_id TEXT NOT NULL,"
+            " updated_at INTEGER NOT NULL,"
+            " PRIMARY KEY (chat_id, user_id)"
+            ") WITHOUT ROWID"
+        )
+        self._connection.commit()
+        self._table = table
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load(self, key: ConversationKey) -> str | None:
+        row = self._connection.execute(
+            f"SELECT conversation_id FROM {self._table} WHERE chat_id = ? AND user_id = ?", key
+        ).fetchone()
+        return row[0] if row else None
+
+    def _save_many(self, items: list[tuple[int, int, str, int]]) -> None:
+        with self._connection:
+            self._connection.executemany(
+                f"INSERT INTO {self._table} (chat_id, user_id, conversation_id, updated_at)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (chat_id, user_id) DO UPDATE SET"
+                " conversation_id = excluded.conversation_id, updated_at = excluded.updated_at",
+                items,
+            )
+
+    async def load(self, key: ConversationKey) -> str | None:
+        return await self._run(self._load, key)
+
+    async def save_many(self, items: Iterable[tuple[ConversationKey, str]]) -> None:
+        now = int(time.time())
+        rows = [(chat_id, user_id, conversation_id, now) for (chat_id, user_id), conversation_id in items]
+        if rows:
+            await self._run(self._save_many, rows)
+
+    async def close(self) -> None:
+        await self._run(self._connection.close)
+        self._executor.shutdown(wait=True)
+
+
+class ConversationStore:
+    """Maps chats/users to Dify conversation ids.
+
+    Lookups are served from an in-memory LRU tier with a TTL, misses fall through
+    to the backend once and are cached (including "no conversation yet").
+    Writes land in memory immediately and are flushed to the backend in batches
+    by a background task.
+    """
+
+    def __init__(
+            self,
+            backend: ConversationBackend,
+            cache_size: int = 10000,
+            cache_ttl: float = 60 * 60 * 24,
+            flush_interval: float = 2,
+            flush_batch: int = 500,
+    ) -> None:
+        self._backend = backend
+        self._cache: OrderedDict[ConversationKey, tuple[str | None, float]] = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._dirty: dict[ConversationKey, str] = {}
+        self._flush_interval = flush_interval
+        self._flush_batch = flush_batch
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task: asyncio.Task | None = None
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_config(cls, config: ConversationConfig, persona: str | None = None) -> ConversationStore:
+        """Store of the main bot, or of ``persona`` in a table of its own."""
+        table = f"conversations_{persona}" if persona else "conversations"
+        backend = SQLiteBackend(config.db_path, table) if config.db_path else MemoryBackend()
+        return cls(
+            backend,
+            cache_size=config.cache_size,
+            cache_ttl=config.cache_ttl,
+            flush_interval=config.flush_interval,
+        )
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, key: ConversationKey, conversation_id: str | None) -> None:
+        self._cache[key] = (conversation_id, time.monotonic() + self._cache_ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, key: ConversationKey) -> str | None:
+        entry = self._cache.get(key)
+        if entry is not None:
+            conversation_id, expires_at = entry
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(key)
+                return conversation_id
+            del self._cache[key]
+
+        conversation_id = self._dirty.get(key, _MISSING)
+        if conversation_id is _MISSING:
+            conversation_id = await self._backend.load(key)
+        self._remember(key, conversation_id)
+        return conversation_id
+
+    def set(self, key: ConversationKey, conversation_id: str) -> None:
+        self._remember(key, conversation_id)
+        self._dirty[key] = conversation_id
+        if len(self._dirty) >= self._flush_batch:
+            self._flush_wakeup.set()
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self._backend.save_many(batch.items())
+        except Exception:
+            # keep the newer values written while flushing
+            self._dirty = {**batch, **self._dirty}
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._flush_wakeup.wait(), self._flush_interval)
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.log.exception("Failed to flush %d conversations", len(self._dirty))
+
+    async def start(self) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        await self._backend.close()
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Hashable
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Batch(Generic[T]):
+    items: list[T]
+    flush_at: float
+    latest_at: float  # flush_at never moves past it
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class MessageDebouncer(Generic[T]):
+    """Merges the messages a conversation sends in a quick row into one batch.
+
+    A batch is flushed once the conversation stayed quiet for ``window``
+    seconds, every new message restarts the window but a batch never waits
+    more than ``max_wait`` seconds after its first message. While the previous
+    batch of the conversation is still being answered the next one stays open,
+    messages sent meanwhile are answered together once it is done.
+    """
+
+    def __init__(
+            self,
+            flush: Callable[[Hashable, list[T]], Awaitable[None]],
+            window: float = 1.5,
+            max_wait: float = 6,
+    ) -> None:
+        self._flush = flush
+        self._window = window
+        self._max_wait = max_wait
+        self._batches: dict[Hashable, _Batch[T]] = {}
+        self._running: dict[Hashable, _Batch[T]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __len__(self) -> int:
+        return sum(len(batch.items) for batch in self._batches.values())
+
+    def add(self, key: Hashable, item: T) -> None:
+        now = asyncio.get_running_loop().time()
+        batch = self._batches.get(key)
+        if batch is None:
+            self._batches[key] = _Batch([item], now + self._window, now + self._max_wait)
+            task = asyncio.create_task(self._flush_later(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            batch.items.append(item)
+            batch.flush_at = min(now + self._window, batch.latest_at)
+
+    async def _flush_later(self, key: Hashable) -> None:
+        loop = asyncio.get_running_loop()
+        batch = self._batches[key]
+        while (delay := batch.flush_at - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        while (previous := self._running.get(key)) is not None:
+            await previous.done.wait()
+        del self._batches[key]
+        self._running[key] = batch
+        try:
+            await self._flush(key, batch.items)
+        except Exception:
+            self.log.exception("Failed to answer %d messages of %s", len(batch.items), key)
+        finally:
+            del self._running[key]
+            batch.done.set()
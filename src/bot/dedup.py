@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Hashable
+
+    from aiogram import Bot
+
+    from src.bot.state import JsonStateFile
+
+# Telegram restarts update ids at a random value after a week without updates, an id this far below the offset
+# belongs to such a new sequence instead of being an old update
+_SEQUENCE_RESET = 100_000
+
+
+class RecentKeys:
+    """The last ``capacity`` keys, a ring buffer with a set for lookups so memory stays fixed.
+
+    With a ``capacity`` of 0 nothing is remembered and every key is new.
+    """
+
+    def __init__(self, capacity: int = 10_000) -> None:
+        self._ring: list[Hashable | None] = [None] * capacity
+        self._index = 0
+        self._keys: set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: Hashable) -> bool:
+        """Remember ``key``, return False when it is already remembered."""
+        if not self._ring:
+            return True
+        if key in self._keys:
+            return False
+        evicted = self._ring[self._index]
+        if evicted is not None:
+            self._keys.discard(evicted)
+        self._ring[self._index] = key
+        self._keys.add(key)
+        self._index = (self._index + 1) % len(self._ring)
+        return True
+
+
+class UpdateOffsets:
+    """Per bot, the update id below which every update was handled, persisted across restarts.
+
+    Only for long polling, which gets the updates of a bot in order: the offset
+    moves past an update once all the earlier ones it saw are done, so no id
+    below it can still arrive. Webhook deliveries can come out of order or be
+    retried after a 503, they must not be tracked here. Polling resumes from the
+    offset after a restart, updates below it fetched again are duplicates.
+    """
+
+    def __init__(self, state: JsonStateFile) -> None:
+        self._state_file = state
+        self._offsets: dict[int, int] = {}
+        self._highest: dict[int, int] = {}
+        self._pending: dict[int, set[int]] = {}
+        self._dirty = False
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    async def load(self) -> None:
+        state = await self._state_file.load()
+        self._offsets = {int(bot_id): offset for bot_id, offset in state.get("offsets", {}).items()}
+
+    async def save(self) -> None:
+        if self._dirty:
+            self._dirty = False
+            await self._state_file.save({"offsets": {str(bot_id): offset for bot_id, offset in self._offsets.items()}})
+
+    async def run(self, interval: float = 5) -> None:
+        """Save the offsets every ``interval`` seconds when they moved."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except OSError:
+                self.log.exception("Failed to save the update offsets")
+
+    def get(self, bot_id: int) -> int | None:
+        return self._offsets.get(bot_id)
+
+    def handled(self, bot_id: int, update_id: int) -> bool:
+        """Whether ``update_id`` is below the offset, i.e. was handled before."""
+        offset = self._offsets.get(bot_id)
+        return offset is not None and offset - _SEQUENCE_RESET < update_id < offset
+
+    def begin(self, bot_id: int, update_id: int) -> None:
+        self._pending.setdefault(bot_id, set()).add(update_id)
+
+    def done(self, bot_id: int, update_id: int) -> None:
+        pending = self._pending.get(bot_id, set())
+        pending.discard(update_id)
+        highest = self._highest[bot_id] = max(self._highest.get(bot_id, update_id), update_id)
+        offset = min(pending) if pending else highest + 1
+        if offset != self._offsets.get(bot_id) and not self.handled(bot_id, offset):
+            self._offsets[bot_id] = offset
+            self._dirty = True
+
+    async def confirm(self, bot: Bot) -> None:
+        """Tell Telegram the updates of ``bot`` below its offset were handled, so polling doesn't fetch them again."""
+        offset = self._offsets.get(bot.id)
+        if offset is not None:
+            await bot.get_updates(offset=offset, limit=1, timeout=0)
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import TYPE_CHECKING, Any
+
+from aiogram.methods import SendMessage
+
+from src.bot.markdown import split_markdown_v2
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from aiogram import Bot
+
+    from src.agent.news import Conversations
+    from src.bot.sender import SendScheduler
+    from src.bot.state import JsonStateFile
+
+DIALOGUE_LINES = registry.counter("dialogue_lines_total", "Scripted dialogue lines by outcome.", ("result",))
+
+
+class DialoguePlayer:
+    """Plays scripted dialogues, every line is sent by the bot of its persona.
+
+    The lines of all groups wait on one heap ordered by the time they are due
+    and a single task sends them, so many groups and long scripts cost one
+    timer instead of one sleeping task per group. Each ``delayTime`` counts
+    from the previous line. Lines not sent yet are persisted and played after
+    a restart, overdue ones are sent right away.
+    """
+
+    def __init__(
+            self,
+            bots: Mapping[str, Bot],
+            sender: SendScheduler,
+            state: JsonStateFile,
+            default: str | None = None,
+    ) -> None:
+        self._bots = bots
+        self._sender = sender
+        self._state_file = state
+        self._default = default
+        # (due at, sequence, chat id, persona, MarkdownV2 chunks)
+        self._heap: list[tuple[float, int, int, str, list[str]]] = []
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+        self._dirty = False
+        self.log = logging.getLogger(self.__class__.__name__)
+        registry.gauge("dialogue_lines_pending", "Scripted dialogue lines waiting to be sent.").labels().set_function(
+            lambda: len(self._heap))
+
+    def _push(self, due_at: float, chat_id: int | str, user: str, chunks: list[str]) -> None:
+        heapq.heappush(self._heap, (due_at, next(self._sequence), chat_id, user, chunks))
+
+    def _touch(self) -> None:
+        self._dirty = True
+        self._changed.set()
+
+    def play(
+            self,
+            chat_ids: Iterable[int | str],
+            conversations: list[Conversations],
+            start_at: float | None = None,
+            spacing: float = 0,
+    ) -> None:
+        """Schedule ``conversations`` in every chat, the chats start ``spacing`` seconds apart."""
+        rendered = [(line.user, line.delayTime, split_markdown_v2(line.content)) for line in conversations]
+        start_at = time.time() if start_at is None else start_at
+        for i, chat_id in enumerate(chat_ids):
+            due_at = start_at + i * spacing
+            for user, delay, chunks in rendered:
+                due_at += delay
+                if chunks:
+                    self._push(due_at, chat_id, user, chunks)
+        self._touch()
+
+    def cancel(self, chat_id: int | str | None = None) -> int:
+        """Drop the lines not sent yet in ``chat_id`` (all chats by default), return how many were dropped."""
+        before = len(self._heap)
+        if chat_id is None:
+            self._heap.clear()
+        else:
+            self._heap = [entry for entry in self._heap if entry[2] != chat_id]
+            heapq.heapify(self._heap)
+        dropped = before - len(self._heap)
+        if dropped:
+            DIALOGUE_LINES.labels("cancelled").inc(dropped)
+            self._touch()
+        return dropped
+
+    def _snapshot(self) -> dict[str, Any]:
+        return {"lines": [
+            {"at": due_at, "chat_id": chat_id, "user": user, "chunks": chunks}
+            for due_at, _, chat_id, user, chunks in sorted(self._heap)
+        ]}
+
+    async def _save(self) -> None:
+        self._dirty = False
+        await self._state_file.save(self._snapshot())
+
+    async def _send(self, chat_id: int | str, lines: list[tuple[str, list[str]]]) -> None:
+        for user, chunks in lines:
+            bot = self._bots.get(user) or self._bots.get(self._default)
+            if bot is None:
+                self.log.warning("No bot plays %r, skipping its line in %s", user, chat_id)
+                DIALOGUE_LINES.labels("skipped").inc()
+                continue
+            try:
+                for chunk in chunks:
+                    await self._sender.send(SendMessage(chat_id=chat_id, text=chunk, parse_mode="MarkdownV2"), bot)
+            except Exception:
+                self.log.exception("Failed to send a line of %r to %s", user, chat_id)
+                DIALOGUE_LINES.labels("failed").inc()
+            else:
+                DIALOGUE_LINES.labels("sent").inc()
+
+    async def load(self) -> None:
+        """Restore the persisted lines, before anything is played."""
+        state = await self._state_file.load()
+        self._heap = []  # the file is the source of truth, also when the run is restarted
+        for line in state.get("lines", []):
+            self._push(line["at"], line["chat_id"], line["user"], line["chunks"])
+
+    async def run(self) -> None:
+        """Send the lines as they become due, call :meth:`load` first."""
+        while True:
+            if self._dirty:
+                await self._save()
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # send every due line, in order within a chat and concurrently across chats
+            now = time.time()
+            due: dict[int, list[tuple[str, list[str]]]] = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, _, chat_id, user, chunks = heapq.heappop(self._heap)
+                due.setdefault(chat_id, []).append((user, chunks))
+            self._dirty = True
+            await asyncio.gather(*(self._send(chat_id, lines) for chat_id, lines in due.items()))
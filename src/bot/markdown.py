@@ -0,0 +1,141 @@
+"""MarkdownV2 escaping: keep the formatting the agent writes, escape everything else."""
+from __future__ import annotations
+
+import re
+import time
+from collections.abc import Iterator
+
+from src.metrics import registry
+
+# Telegram message text limit
+MAX_MESSAGE_LENGTH = 4096
+
+_ESCAPE_SECONDS = registry.histogram(
+    "markdown_escape_seconds", "Time spent escaping MarkdownV2 text.", ("function",)
+)
+_escape_seconds = _ESCAPE_SECONDS.labels("escape_markdown_v2")
+_split_seconds = _ESCAPE_SECONDS.labels("split_markdown_v2")
+
+_ESCAPE = str.maketrans({char: f"\\{char}" for char in r"_*[]()~`>#+-=|{}.!\\"})
+
+# 匹配 MarkdownV2 的核心结构（非贪婪匹配，优先处理链接），一次匹配即可按分组判断类型
+_TOKEN = re.compile(
+    r'\[(?P<link_text>.*?)\]\((?P<link_url>\S*?)\)'  # 链接 [text](url)，URL中不允许空格
+    r'|\*\*(?P<bold>.*?)\*\*'  # 粗体 **text**
+    r'|(?P<star>\*.*?\*)'  # 斜体 *text*，原样保留
+    r'|__(?P<underline>.*?)__'  # 下划线 __text__
+    r'|_(?P<italic>.*?)_'  # 斜体 _text_
+    r'|`(?P<code>.*?)`'  # 行内代码 `text`，也会先于 ``` 匹配多行代码块的每一段
+    r'|(?P<newline>\\n)'  # 换行
+    , re.DOTALL)
+
+
+def _render(match: re.Match) -> str:
+    kind = match.lastgroup
+    if kind == "link_url":
+        return f'[{match["link_text"].translate(_ESCAPE)}]({match["link_url"].translate(_ESCAPE)})'
+    if kind == "bold":
+        return f'**{match["bold"].translate(_ESCAPE)}**'
+    if kind == "underline":
+        return f'__{match["underline"].translate(_ESCAPE)}__'
+    if kind == "italic":
+        text = match["italic"]
+        # 跨行的 _text_ / `text` 不当作格式，原样保留
+        return match.group() if "\n" in text else f'_{text.translate(_ESCAPE)}_'
+    if kind == "code":
+        text = match["code"]
+        return match.group() if "\n" in text else f'`{text.translate(_ESCAPE)}`'
+    if kind == "newline":
+        return "\n"
+    return match.group()
+
+
+def escape_markdown_v2(text: str) -> str:
+    """
+    保留 MarkdownV2 结构（链接、粗体等），转义其他部分的保留字符
+    """
+    started = time.perf_counter()
+    parts = []
+    last_end = 0
+    for match in _TOKEN.finditer(text):
+        start = match.start()
+        # 转义非结构化的普通文本
+        if start > last_end:
+            parts.append(text[last_end:start].translate(_ESCAPE))
+        parts.append(_render(match))
+        last_end = match.end()
+
+    # 处理剩余文本
+    if last_end < len(text):
+        parts.append(text[last_end:].translate(_ESCAPE))
+    result = "".join(parts)
+    _escape_seconds.observe(time.perf_counter() - started)
+    return result
+
+
+def _pieces(text: str) -> Iterator[tuple[str, str | None]]:
+    """Yield escaped pieces, formatted ones together with their source text."""
+    last_end = 0
+    for match in _TOKEN.finditer(text):
+        start = match.start()
+        if start > last_end:
+            yield text[last_end:start].translate(_ESCAPE), None
+        yield _render(match), match.group()
+        last_end = match.end()
+    if last_end < len(text):
+        yield text[last_end:].translate(_ESCAPE), None
+
+
+def _cut_position(text: str, room: int) -> int:
+    """Where to cut escaped plain ``text`` to fit ``room``, preferring line and word ends."""
+    if len(text) <= room:
+        return len(text)
+    cut = text.rfind("\n", 0, room) + 1
+    if cut <= room // 2:
+        cut = text.rfind(" ", 0, room) + 1
+    if cut <= room // 2:
+        cut = room
+    # never separate a backslash from the character it escapes
+    backslashes = 0
+    while backslashes < cut and text[cut - 1 - backslashes] == "\\":
+        backslashes += 1
+    if backslashes % 2:
+        cut -= 1
+    return cut
+
+
+def split_markdown_v2(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list[str]:
+    """Escape ``text`` like :func:`escape_markdown_v2` and split it into messages of at most ``limit`` chars.
+
+    Formatted parts are never split, one that alone exceeds ``limit`` is sent
+    as escaped plain text instead.
+    """
+    started = time.perf_counter()
+    chunks: list[str] = []
+    current: list[str] = []
+    size = 0
+    for piece, source in _pieces(text):
+        if size + len(piece) <= limit:
+            current.append(piece)
+            size += len(piece)
+            continue
+        if source is not None:
+            if len(piece) <= limit:
+                chunks.append("".join(current))
+                current, size = [piece], len(piece)
+                continue
+            piece = source.translate(_ESCAPE)
+        while size + len(piece) > limit:
+            cut = _cut_position(piece, limit - size)
+            if cut:
+                current.append(piece[:cut])
+                piece = piece[cut:]
+            chunks.append("".join(current))
+            current, size = [], 0
+        if piece:
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append("".join(current))
+    _split_seconds.observe(time.perf_counter() - started)
+    return [chunk for chunk in chunks if chunk]
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+from aiogram import BaseMiddleware
+from aiogram.enums import ChatType, MessageEntityType
+
+from src.bot.dedup import RecentKeys
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from aiogram import Bot
+    from aiogram.types import Message, TelegramObject, Update
+
+    from src.bot.dedup import UpdateOffsets
+
+HANDLER_SECONDS = registry.histogram("handler_seconds", "End-to-end latency of update handlers.", ("handler",))
+
+
+class HandlerLatencyMiddleware(BaseMiddleware):
+    """Observes how long each handler takes, labeled by the handler function name."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        with HANDLER_SECONDS.labels(name).time():
+            return await handler(event, data)
+
+
+PREFILTER = registry.counter("prefilter_messages_total", "Messages by outcome of the pre-dispatch filter.", ("result",))
+
+
+class AddressedFilterMiddleware(BaseMiddleware):
+    """Drops group messages not addressed to the bot before any handler, storage or network work.
+
+    A group message passes when it mentions the bot (``@username`` or a text
+    mention of its id), replies to one of its messages or is a command.
+    Handlers get ``addressed`` telling whether the bot was asked to answer;
+    private messages always are. The identity of each bot comes from one
+    ``get_me`` call, done by :meth:`load` at startup.
+    """
+
+    def __init__(self) -> None:
+        self._usernames: dict[int, str] = {}
+        self._passed = PREFILTER.labels("passed")
+        self._no_text = PREFILTER.labels("no_text")
+        self._not_addressed = PREFILTER.labels("not_addressed")
+        self._other_chat = PREFILTER.labels("other_chat")
+
+    async def load(self, bot: Bot) -> None:
+        me = await bot.me()
+        self._usernames[bot.id] = f"@{me.username}".lower() if me.username else ""
+
+    def _addressed(self, message: Message, bot_id: int, username: str) -> bool:
+        reply = message.reply_to_message
+        if reply is not None and reply.from_user is not None and reply.from_user.id == bot_id:
+            return True
+        for entity in message.entities or ():
+            if entity.type == MessageEntityType.MENTION:
+                if username and entity.extract_from(message.text).lower() == username:
+                    return True
+            elif entity.type == MessageEntityType.TEXT_MENTION:
+                if entity.user is not None and entity.user.id == bot_id:
+                    return True
+        return False
+
+    @staticmethod
+    def _is_command(message: Message) -> bool:
+        entities = message.entities
+        return bool(entities) and entities[0].type == MessageEntityType.BOT_COMMAND and entities[0].offset == 0
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Message,
+            data: dict[str, Any],
+    ) -> Any:
+        if event.text is None:
+            self._no_text.inc()
+            return None
+        chat_type = event.chat.type
+        if chat_type == ChatType.PRIVATE:
+            addressed = True
+        elif chat_type in (ChatType.GROUP, ChatType.SUPERGROUP):
+            bot: Bot = data["bot"]
+            if bot.id not in self._usernames:
+                await self.load(bot)  # not loaded at startup, aiogram caches the answer
+            addressed = self._addressed(event, bot.id, self._usernames[bot.id])
+            if not addressed and not self._is_command(event):
+                self._not_addressed.inc()
+                return None
+        else:
+            self._other_chat.inc()
+            return None
+        self._passed.inc()
+        data["addressed"] = addressed
+        return await handler(event, data)
+
+
+DUPLICATES = registry.counter("duplicate_updates_total", "Updates dropped as already handled, by check.", ("check",))
+
+
+class DeduplicateMiddleware(BaseMiddleware):
+    """Drops updates Telegram delivers again, before any handler runs.
+
+    Restarted polling and retried webhook deliveries repeat updates, which
+    would be answered twice. The last ``capacity`` update ids and message ids
+    of every bot are remembered, and with ``offsets`` updates below the
+    persisted offset of their bot are dropped after a restart too.
+    """
+
+    def __init__(self, capacity: int = 10_000, offsets: UpdateOffsets | None = None) -> None:
+        self._recent = RecentKeys(capacity)
+        self._offsets = offsets
+        self._offset = DUPLICATES.labels("offset")
+        self._update_id = DUPLICATES.labels("update_id")
+        self._message = DUPLICATES.labels("message")
+        registry.gauge("dedup_keys", "Update and message ids remembered for de-duplication.").labels().set_function(
+            lambda: len(self._recent))
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: dict[str, Any],
+    ) -> Any:
+        bot_id = data["bot"].id
+        update_id = event.update_id
+        if self._offsets is not None and self._offsets.handled(bot_id, update_id):
+            self._offset.inc()
+            return None
+        if not self._recent.add((bot_id, update_id)):
+            self._update_id.inc()
+            return None
+        message = event.message
+        if message is not None and not self._recent.add((bot_id, message.chat.id, message.message_id)):
+            self._message.inc()
+            return None
+        if self._offsets is None:
+            return await handler(event, data)
+        self._offsets.begin(bot_id, update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            self._offsets.done(bot_id, update_id)
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+from dataclasses import asdict
+from typing import TYPE_CHECKING, Any
+
+from aiogram.methods import SendMessage
+
+from src.agent.news import Conversations, parse_conversations
+from src.bot.markdown import split_markdown_v2
+from src.bot.middlewares import HANDLER_SECONDS
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from aiogram import Bot
+
+    from src.bot.dialogue import DialoguePlayer
+    from src.bot.sender import SendScheduler
+    from src.bot.state import JsonStateFile
+    from src.configuration import NewsConfig
+
+NEWS_TOTAL = registry.counter("news_total", "News generations and deliveries by outcome.", ("result",))
+
+
+class NewsPipeline:
+    """Generates the news ahead of each slot and posts it to every group.
+
+    One generation is rendered to MarkdownV2 chunks once and reused for all
+    groups. The next slot, the prefetched chunks and the groups still waiting
+    for them are persisted, a restart resumes where it stopped instead of
+    posting twice. Failures are logged and retried, they never stop the loop.
+
+    With a ``player`` the workflow returns a scripted dialogue instead, it is
+    handed to the player for every group when the slot comes.
+    """
+
+    def __init__(
+            self,
+            generate: Callable[[], Awaitable[str]],
+            sender: SendScheduler,
+            bot: Bot,
+            groups: tuple[int | str, ...],
+            state: JsonStateFile,
+            min_interval: float = 60 * 60 * 10,
+            max_interval: float = 60 * 60 * 18,
+            prefetch_lead: float = 60 * 30,
+            send_spacing: float = 1,
+            retry_interval: float = 60 * 5,
+            player: DialoguePlayer | None = None,
+    ) -> None:
+        self._generate = generate
+        self._sender = sender
+        self._bot = bot
+        self._groups = groups
+        self._state_file = state
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._prefetch_lead = prefetch_lead
+        self._send_spacing = send_spacing
+        self._retry_interval = retry_interval
+        self._player = player
+        self._delivery_seconds = HANDLER_SECONDS.labels("send_daily_random_messages")
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_config(
+            cls,
+            config: NewsConfig,
+            generate: Callable[[], Awaitable[str]],
+            sender: SendScheduler,
+            bot: Bot,
+            state: JsonStateFile,
+            player: DialoguePlayer | None = None,
+    ) -> NewsPipeline:
+        return cls(
+            generate,
+            sender,
+            bot,
+            config.groups,
+            state,
+            min_interval=config.min_interval,
+            max_interval=config.max_interval,
+            prefetch_lead=config.prefetch_lead,
+            send_spacing=config.send_spacing,
+            retry_interval=config.retry_interval,
+            player=player,
+        )
+
+    @staticmethod
+    async def _sleep_until(timestamp: float) -> None:
+        await asyncio.sleep(max(0.0, timestamp - time.time()))
+
+    def _render(self, text: str) -> list[Any]:
+        """MarkdownV2 chunks of the news, or the lines of the dialogue as dicts."""
+        if self._player is not None:
+            return [asdict(line) for line in parse_conversations(text)]
+        return split_markdown_v2(text)
+
+    async def _prefetch(self) -> list[Any] | None:
+        try:
+            text = await self._generate()
+        except Exception:
+            self.log.exception("Failed to generate the news")
+            NEWS_TOTAL.labels("generate_failed").inc()
+            return None
+        chunks = self._render(text) if text else []
+        if not chunks:
+            self.log.warning("The news workflow returned nothing")
+            NEWS_TOTAL.labels("generate_failed").inc()
+            return None
+        NEWS_TOTAL.labels("generated").inc()
+        return chunks
+
+    async def _deliver(self, group: int | str, chunks: list[str]) -> None:
+        try:
+            for chunk in chunks:
+                await self._sender.send(SendMessage(chat_id=group, text=chunk, parse_mode="MarkdownV2"), self._bot)
+        except Exception:
+            self.log.exception("Failed to post the news to %s", group)
+            NEWS_TOTAL.labels("delivery_failed").inc()
+        else:
+            NEWS_TOTAL.labels("delivered").inc()
+
+    async def run(self) -> None:
+        state = await self._state_file.load()
+        # without a saved schedule the first news is posted right away
+        state.setdefault("next_at", time.time())
+        while True:
+            if state.get("chunks") is None:
+                await self._sleep_until(state["next_at"] - self._prefetch_lead)
+                chunks = await self._prefetch()
+                if chunks is None:
+                    await asyncio.sleep(self._retry_interval)
+                    continue
+                state.update(chunks=chunks, pending=list(self._groups))
+                await self._state_file.save(state)
+
+            await self._sleep_until(state["next_at"])
+            with self._delivery_seconds.time():
+                if self._player is not None and state["pending"]:
+                    self._player.play(state["pending"], [Conversations(**line) for line in state["chunks"]],
+                                      spacing=self._send_spacing)
+                    NEWS_TOTAL.labels("delivered").inc(len(state["pending"]))
+                    state["pending"] = []
+                while state["pending"]:
+                    group = state["pending"][0]
+                    await self._deliver(group, state["chunks"])
+                    state["pending"].pop(0)
+                    await self._state_file.save(state)
+                    if state["pending"]:
+                        await asyncio.sleep(self._send_spacing)
+
+            state.update(next_at=time.time() + random.uniform(self._min_interval, self._max_interval), chunks=None,
+                         pending=[])
+            await self._state_file.save(state)
+            self.log.info("Next news at %s", time.ctime(state["next_at"]))
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+    from src.agent.client import Dify
+    from src.bot.conversations import ConversationStore
+
+# the main bot, it greets new members and posts the news
+MAIN_PERSONA = "clementine"
+PERSONAS = (MAIN_PERSONA, "maeve", "teddy")
+
+
+@dataclass(eq=False)
+class Persona:
+    """A bot answering messages with its own Dify app and conversations."""
+
+    name: str
+    bot: Bot
+    dify: Dify
+    conversations: ConversationStore
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, TypeVar
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from src.metrics import registry
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+    from aiogram.methods import TelegramMethod
+
+    from src.configuration import BotConfig
+
+T = TypeVar("T")
+
+REQUEST_SECONDS = registry.histogram(
+    "telegram_request_seconds", "Latency of Telegram Bot API calls, rate limit waits excluded.", ("method",)
+)
+
+
+class TokenBucket:
+    """Token bucket where every call reserves a token, possibly in the future."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = 0.0
+
+    def _refill(self, now: float) -> None:
+        if self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+    def reserve(self, now: float) -> float:
+        """Take a token and return how long to wait before using it."""
+        self._refill(now)
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Make the next reservation wait at least ``seconds``."""
+        self._refill(now)
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+@dataclass
+class SenderStats:
+    pending: int
+    sent: int
+    merged: int
+    retried: int
+    skipped: int
+    failed: int
+
+
+class SendScheduler:
+    """Sends Telegram API calls within the flood limits.
+
+    Each bot has a global bucket and each chat its own bucket (groups are
+    limited per minute, private chats per second). Calls wait in arrival order
+    for a token of their chat and then of their bot, ``retry_after`` from 429
+    responses pauses the chat before the call is retried. An identical call
+    already in flight is not sent twice, its result is shared.
+    """
+
+    _PRUNE_THRESHOLD = 10000
+
+    def __init__(
+            self,
+            global_rate: float = 30,
+            group_rate: float = 20 / 60,
+            private_rate: float = 1,
+            max_retries: int = 3,
+    ) -> None:
+        self._global_rate = global_rate
+        self._group_rate = group_rate
+        self._private_rate = private_rate
+        self._max_retries = max_retries
+        self._bots: dict[int, TokenBucket] = {}
+        self._chats: dict[tuple[int, str], TokenBucket] = {}
+        self._in_flight: dict[tuple[int, str], asyncio.Future] = {}
+        self._pending = 0
+        self._sent = 0
+        self._merged = 0
+        self._retried = 0
+        self._skipped = 0
+        self._failed = 0
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_config(cls, config: BotConfig, processes: int = 1) -> SendScheduler:
+        """``processes`` share the global limit of each bot, chats are not shared between them."""
+        return cls(
+            global_rate=config.send_global_rate / processes,
+            group_rate=config.send_group_rate / 60,
+            private_rate=config.send_private_rate,
+            max_retries=config.send_max_retries,
+        )
+
+    def stats(self) -> SenderStats:
+        return SenderStats(
+            pending=self._pending,
+            sent=self._sent,
+            merged=self._merged,
+            retried=self._retried,
+            skipped=self._skipped,
+            failed=self._failed,
+        )
+
+    def _bot_bucket(self, bot: Bot) -> TokenBucket:
+        bucket = self._bots.get(bot.id)
+        if bucket is None:
+            bucket = self._bots[bot.id] = TokenBucket(self._global_rate, self._global_rate)
+        return bucket
+
+    def _chat_bucket(self, bot: Bot, chat_id: Any, now: float) -> TokenBucket | None:
+        if chat_id is None:
+            return None
+        key = (bot.id, str(chat_id))
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= self._PRUNE_THRESHOLD:
+                self._chats = {k: b for k, b in self._chats.items() if not b.full(now)}
+            # negative ids and @usernames are groups and channels
+            if key[1].startswith(("-", "@")):
+                bucket = TokenBucket(self._group_rate, 3)
+            else:
+                bucket = TokenBucket(self._private_rate, 1)
+            self._chats[key] = bucket
+        return bucket
+
+    async def _wait(self, bucket: TokenBucket) -> None:
+        loop = asyncio.get_running_loop()
+        delay = bucket.reserve(loop.time())
+        if delay > 0:
+            self._pending += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._pending -= 1
+
+    async def _send(self, bot: Bot, method: TelegramMethod[T], retry: bool, wait: bool) -> T | None:
+        loop = asyncio.get_running_loop()
+        chat_id = getattr(method, "chat_id", None)
+        attempt = 0
+        while True:
+            chat_bucket = self._chat_bucket(bot, chat_id, loop.time())
+            bot_bucket = self._bot_bucket(bot)
+            if not wait:
+                now = loop.time()
+                if not bot_bucket.available(now) or (chat_bucket and not chat_bucket.available(now)):
+                    self._skipped += 1
+                    return None
+            if chat_bucket is not None:
+                await self._wait(chat_bucket)
+            await self._wait(bot_bucket)
+            started = time.perf_counter()
+            try:
+                result = await bot(method)
+            except TelegramRetryAfter as e:
+                (chat_bucket or bot_bucket).pause(loop.time(), e.retry_after)
+                if not retry or attempt >= self._max_retries:
+                    self._failed += 1
+                    raise
+                attempt += 1
+                self._retried += 1
+                self.log.warning("Flood control in chat %s, retrying in %s seconds", chat_id, e.retry_after)
+                continue
+            except Exception:
+                self._failed += 1
+                raise
+            finally:
+                REQUEST_SECONDS.labels(method.__api_method__).observe(time.perf_counter() - started)
+            self._sent += 1
+            return result
+
+    async def send(
+            self,
+            method: TelegramMethod[T],
+            bot: Bot | None = None,
+            retry: bool = True,
+            wait: bool = True,
+    ) -> T | None:
+        """Send ``method`` with ``bot`` (defaults to the bot the method is bound to).
+
+        With ``retry=False`` flood errors are raised instead of retried, with
+        ``wait=False`` the call is dropped (returning None) when it can't be
+        sent right away.
+        """
+        bot = bot or method.bot
+        key = (bot.id, repr(method))
+        if (task := self._in_flight.get(key)) is not None:
+            self._merged += 1
+            return await asyncio.shield(task)
+
+        task = asyncio.ensure_future(self._send(bot, method, retry, wait))
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await task
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any
+
+
+class JsonStateFile:
+    """Small JSON document persisted across restarts, replaced atomically on every save."""
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def _load(self) -> dict[str, Any]:
+        try:
+            with open(self._path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            self.log.warning("Ignoring unreadable state file %s", self._path)
+            return {}
+
+    def _save(self, state: dict[str, Any]) -> None:
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self._path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temporary, self._path)
+
+    async def load(self) -> dict[str, Any]:
+        return await asyncio.to_thread(self._load)
+
+    async def save(self, state: dict[str, Any]) -> None:
+        await asyncio.to_thread(self._save, state)
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from contextlib import aclosing
+from typing import TYPE_CHECKING
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Callable
+
+    from aiogram.types import Message
+
+    from src.agent.base import Response
+    from src.bot.sender import SendScheduler
+
+logger = logging.getLogger(__name__)
+
+# Telegram message text limit
+MAX_TEXT_LENGTH = 4096
+
+
+class StreamingReply:
+    """Shows an answer while it is generated by editing a single reply.
+
+    Intermediate texts are sent as plain text and coalesced so that at most one
+    edit is made every ``min_interval`` seconds (and only when the chat is not
+    rate limited), the final text is sent once, rendered by ``render`` into
+    MarkdownV2 messages (continuation messages are sent after the edited reply).
+    """
+
+    def __init__(
+            self,
+            message: Message,
+            sender: SendScheduler,
+            render: Callable[[str], list[str]],
+            min_interval: float = 1.5,
+            placeholder: str = "…",
+    ) -> None:
+        self._message = message
+        self._sender = sender
+        self._render = render
+        self._min_interval = min_interval
+        self._placeholder = placeholder
+        self._reply: Message | None = None
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def start(self) -> None:
+        """Send the placeholder reply."""
+        if self._reply is None:
+            self._reply = await self._sender.send(self._message.reply(self._placeholder, parse_mode=None))
+            self._next_edit = asyncio.get_running_loop().time() + self._min_interval
+
+    async def update(self, text: str) -> None:
+        """Show ``text`` unless an edit was made less than ``min_interval`` ago."""
+        await self.start()
+        now = asyncio.get_running_loop().time()
+        text = text[:MAX_TEXT_LENGTH]
+        if now < self._next_edit or text == self._shown:
+            return
+        self._next_edit = now + self._min_interval
+        try:
+            if await self._sender.send(self._reply.edit_text(text, parse_mode=None), retry=False, wait=False):
+                self._shown = text
+        except TelegramRetryAfter as e:
+            self._next_edit = now + e.retry_after
+        except TelegramBadRequest as e:
+            logger.debug("Skipping intermediate edit: %s", e)
+
+    async def finish(self, text: str) -> None:
+        """Show the final ``text`` formatted as MarkdownV2."""
+        first, *rest = self._render(text) or [""]
+        if self._reply is None:
+            await self._sender.send(self._message.reply(first, parse_mode="MarkdownV2"))
+        elif first != self._shown:
+            try:
+                await self._sender.send(self._reply.edit_text(first, parse_mode="MarkdownV2"))
+            except TelegramBadRequest as e:
+                # the formatted text can render exactly like the last intermediate edit
+                if "message is not modified" not in e.message:
+                    raise
+        for chunk in rest:
+            await self._sender.send(self._message.answer(chunk, parse_mode="MarkdownV2"))
+
+    async def discard(self) -> None:
+        """Delete the placeholder when no answer is going to be shown."""
+        if self._reply is not None:
+            try:
+                await self._sender.send(self._reply.delete())
+            except TelegramBadRequest as e:
+                logger.debug("Failed to delete placeholder: %s", e)
+            self._reply = None
+
+
+async def reply_streaming(
+        message: Message,
+        responses: AsyncGenerator[Response, None],
+        sender: SendScheduler,
+        render: Callable[[str], list[str]],
+        min_interval: float = 1.5,
+) -> Response | None:
+    """Reply to ``message`` with a streamed answer and return the final response.
+
+    ``responses`` is closed before returning, also when sending failed, so its request is closed right away.
+    """
+    reply = StreamingReply(message, sender, render, min_interval=min_interval)
+    response = None
+    try:
+        async with aclosing(responses):
+            # lag one item behind so the final response is only shown by finish()
+            async for item in responses:
+                if response is not None and response.need_response:
+                    await reply.update(response.message)
+                response = item
+    except BaseException:
+        await reply.discard()
+        raise
+    if response is not None and response.need_response:
+        await reply.finish(response.message)
+    else:
+        await reply.discard()
+    return response
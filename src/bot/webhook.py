@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import logging
+import signal
+from contextlib import suppress
+from typing import TYPE_CHECKING, Any
+
+from aiohttp import web
+from aiogram.types import Update
+from ujson import loads
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+    from aiogram import Bot, Dispatcher
+
+    from src.configuration import WebhookConfig
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# route of the worker ingress behind the cluster front
+WORKER_PATH = "/update"
+
+
+def persona_path(path: str, persona: str) -> str:
+    """Route of a persona bot, the main bot (the first one) keeps ``path`` itself."""
+    return f"{path.rstrip('/')}/{persona}"
+
+
+async def set_webhooks(bots: Mapping[str, Bot], config: WebhookConfig, allowed_updates: list[str]) -> None:
+    """Point the webhook of each bot to its route, the first bot to ``config.url``."""
+    for i, (persona, bot) in enumerate(bots.items()):
+        await bot.set_webhook(
+            url=config.url if i == 0 else persona_path(config.url, persona),
+            secret_token=config.secret,
+            allowed_updates=allowed_updates,
+        )
+
+
+class WebhookIngress:
+    """Receives Telegram updates over HTTP and feeds them to the dispatcher.
+
+    Requests are acknowledged as soon as the update is queued, a fixed number of
+    workers drain the bounded queue. When the queue is full the request is
+    rejected with 503 so Telegram (or the load balancer) retries later.
+    Updates of the first bot of ``bots`` arrive on the path itself, those of
+    the others on :func:`persona_path`.
+    """
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            bots: Mapping[str, Bot],
+            secret: str | None = None,
+            queue_size: int = 1000,
+            workers: int = 16,
+    ) -> None:
+        self._dispatcher = dispatcher
+        self._bots = bots
+        self._main_bot = next(iter(bots.values()))
+        self._secret = secret
+        self._queue: asyncio.Queue[tuple[Bot, dict[str, Any]]] = asyncio.Queue(maxsize=queue_size)
+        self._workers = workers
+        self._tasks: list[asyncio.Task] = []
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def register(self, app: web.Application, path: str) -> None:
+        """Add the update route and worker lifecycle to ``app``."""
+        app.router.add_post(path, self.handle)
+        if len(self._bots) > 1:
+            app.router.add_post(persona_path(path, "{persona}"), self.handle)
+        app.on_startup.append(self._start_workers)
+        app.on_shutdown.append(self._stop_workers)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._secret and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, "").encode(), self._secret.encode()
+        ):
+            return web.Response(status=401)
+        persona = request.match_info.get("persona")
+        bot = self._bots.get(persona) if persona else self._main_bot
+        if bot is None:
+            return web.Response(status=404)
+        try:
+            update = await request.json(loads=loads)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait((bot, update))
+        except asyncio.QueueFull:
+            self.log.warning("Intake queue is full, rejecting update %s", update.get("update_id"))
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            bot, raw = await self._queue.get()
+            try:
+                update = Update.model_validate(raw, context={"bot": bot})
+                await self._dispatcher.feed_update(bot, update)
+            except Exception:
+                # never let one bad update end a worker
+                update_id = raw.get("update_id") if isinstance(raw, dict) else None
+                self.log.exception("Failed to process update %s", update_id)
+            finally:
+                self._queue.task_done()
+
+    async def _start_workers(self, app: web.Application) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self._workers)]
+
+    async def _stop_workers(self, app: web.Application) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+
+def create_webhook_app(dispatcher: Dispatcher, bots: Mapping[str, Bot], config: WebhookConfig) -> web.Application:
+    """Build the aiohttp application serving the webhook routes."""
+    app = web.Application()
+    ingress = WebhookIngress(
+        dispatcher,
+        bots,
+        secret=config.secret,
+        queue_size=config.queue_size,
+        workers=config.workers,
+    )
+    ingress.register(app, config.path)
+    return app
+
+
+async def run_webhook(
+        dispatcher: Dispatcher,
+        bots: Mapping[str, Bot],
+        config: WebhookConfig,
+        socket_path: str | None = None,
+) -> None:
+    """Register the webhook of every bot with Telegram and serve updates until stopped.
+
+    With ``socket_path`` updates are served on that unix socket to the cluster
+    front, which owns the webhooks, instead. The bots share one session.
+    """
+    log = logging.getLogger(__name__)
+    bot = next(iter(bots.values()))
+    if socket_path:
+        app = web.Application()
+        WebhookIngress(dispatcher, bots, queue_size=config.queue_size, workers=config.workers).register(
+            app, WORKER_PATH)
+    else:
+        if not config.secret:
+            log.warning("WEBHOOK_SECRET is not set, incoming updates are not authenticated")
+        app = create_webhook_app(dispatcher, bots, config)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    if socket_path:
+        site = web.UnixSite(runner, socket_path)
+    else:
+        site = web.TCPSite(runner, host=config.host, port=config.port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # workers also get the SIGINT of the terminal, the front stops them
+    for sig in (signal.SIGTERM, signal.SIGINT) if socket_path else (signal.SIGTERM,):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    await site.start()
+    if not socket_path:
+        await set_webhooks(bots, config, dispatcher.resolve_used_update_types())
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+    log.info("Listening on %s", socket_path or f"{config.host}:{config.port}{config.path}")
+    try:
+        await stop.wait()
+    finally:
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher, **dispatcher.workflow_data)
+        await runner.cleanup()
+        await bot.session.close()
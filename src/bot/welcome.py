@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Hashable
+
+T = TypeVar("T")
+
+MEMBERS_PLACEHOLDER = "{members}"
+
+
+class JoinAggregator(Generic[T]):
+    """Collects joins per chat for ``window`` seconds and greets them with one call."""
+
+    def __init__(self, greet: Callable[[Hashable, list[T]], Awaitable[None]], window: float = 3) -> None:
+        self._greet = greet
+        self._window = window
+        self._batches: dict[Hashable, list[T]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def add(self, chat_id: Hashable, item: T) -> None:
+        batch = self._batches.get(chat_id)
+        if batch is None:
+            self._batches[chat_id] = [item]
+            task = asyncio.create_task(self._flush_later(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            batch.append(item)
+
+    async def _flush_later(self, chat_id: Hashable) -> None:
+        await asyncio.sleep(self._window)
+        items = self._batches.pop(chat_id)
+        try:
+            await self._greet(chat_id, items)
+        except Exception:
+            self.log.exception("Failed to greet %d members in chat %s", len(items), chat_id)
+
+
+class WelcomeTemplate:
+    """Welcome text generated ahead of time, used instead of the agent during join floods.
+
+    The template contains ``{members}`` where the new members are mentioned.
+    A failed refresh is tried again after ``retry_interval`` seconds instead of ``ttl``.
+    """
+
+    def __init__(self, default: str, ttl: float = 60 * 60 * 6, retry_interval: float = 60) -> None:
+        self._template = default
+        self._ttl = ttl
+        self._retry_interval = retry_interval
+        self._expires_at = 0.0
+        self._refreshing: asyncio.Task | None = None
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def render(self, members: str) -> str:
+        return self._template.replace(MEMBERS_PLACEHOLDER, members)
+
+    def refresh(self, generate: Callable[[], Awaitable[str | None]]) -> None:
+        """Regenerate the template in the background once it is expired."""
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._expires_at or self._refreshing is not None:
+            return
+        self._refreshing = asyncio.create_task(self._refresh(generate))
+
+    async def _refresh(self, generate: Callable[[], Awaitable[str | None]]) -> None:
+        ttl = self._ttl
+        try:
+            template = await generate()
+        except Exception:
+            self.log.exception("Failed to generate welcome template, retrying in %ss", self._retry_interval)
+            template = None
+            ttl = self._retry_interval
+        finally:
+            self._refreshing = None
+        if template:
+            if MEMBERS_PLACEHOLDER not in template:
+                template = f"{MEMBERS_PLACEHOLDER} {template}"
+            self._template = template
+        self._expires_at = asyncio.get_running_loop().time() + ttl
@@ -8,6 +8,26 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def _backends(name: str) -> tuple[tuple[str, str | None], ...]:
+    """Parse ``url|api_key`` pairs separated by commas, the key may be omitted."""
+    backends = []
+    for entry in (os.getenv(name) or '').split(','):
+        if entry.strip():
+            url, _, api_key = entry.strip().partition('|')
+            backends.append((url, api_key or None))
+    return tuple(backends)
+
+
+def _chat_ids(value: str | None) -> tuple[int | str, ...]:
+    """Parse comma separated chat ids, numeric ones as ints and ``@channelname`` usernames as they are."""
+    chat_ids = []
+    for entry in (value or '').split(','):
+        entry = entry.strip()
+        if entry:
+            chat_ids.append(int(entry) if entry.lstrip('-').isdigit() else entry)
+    return tuple(chat_ids)
+
+
 @dataclass
 class BotConfig:
     """Bot configuration."""
@@ -16,19 +36,141 @@ class BotConfig:
     maeve_token: str = os.getenv('MAEVE_BOT_TOKEN')
     teddy_token: str = os.getenv('TEDDY_BOT_TOKEN')
     tg_group_id: str = os.getenv('TG_GROUP_ID')
+    # answer messages sent to Maeve and Teddy too, each persona with the Dify app of its own API key
+    serve_personas: bool = os.getenv('SERVE_PERSONAS', 'true').lower() == 'true'
+    streaming_reply: bool = os.getenv('STREAMING_REPLY', 'false').lower() == 'true'
+    streaming_edit_interval: float = float(os.getenv('STREAMING_EDIT_INTERVAL', 1.5))
+    send_global_rate: float = float(os.getenv('TG_SEND_GLOBAL_RATE', 30))  # messages per second per bot
+    send_group_rate: float = float(os.getenv('TG_SEND_GROUP_RATE', 20))  # messages per minute per group
+    send_private_rate: float = float(os.getenv('TG_SEND_PRIVATE_RATE', 1))  # messages per second per private chat
+    send_max_retries: int = int(os.getenv('TG_SEND_MAX_RETRIES', 3))
+    debounce_window: float = float(os.getenv('DEBOUNCE_WINDOW', 0))  # seconds of quiet before answering, 0 disables
+    debounce_max_wait: float = float(os.getenv('DEBOUNCE_MAX_WAIT', 6))
+    dedup_capacity: int = max(0, int(os.getenv('DEDUP_CAPACITY', 10000)))  # ids remembered, 0 disables
+    offsets_path: str = os.getenv('UPDATE_OFFSETS_PATH', 'data/offsets.json')
+    offsets_save_interval: float = float(os.getenv('UPDATE_OFFSETS_SAVE_INTERVAL', 5))
     DEFAULT_LOCALE: str = 'en'
 
 
+@dataclass
+class WelcomeConfig:
+    """Welcome messages, joins within ``batch_window`` seconds are greeted together."""
+
+    batch_window: float = float(os.getenv('WELCOME_BATCH_WINDOW', 3))
+    burst_threshold: int = int(os.getenv('WELCOME_BURST_THRESHOLD', 20))  # more joins use the template
+    max_mentions: int = int(os.getenv('WELCOME_MAX_MENTIONS', 30))
+    template_ttl: float = float(os.getenv('WELCOME_TEMPLATE_TTL', 60 * 60 * 6))
+    template_retry_interval: float = float(os.getenv('WELCOME_TEMPLATE_RETRY_INTERVAL', 60))
+    deadline: float = float(os.getenv('WELCOME_DEADLINE', 30))  # later welcomes use the template
+    default_template: str = os.getenv('WELCOME_DEFAULT_TEMPLATE') or '欢迎 {members} 加入！🎉'
+
+
 @dataclass
 class DifyConfig:
     api_key: str = os.getenv('DIFY_API_KEY')
     base_url: str = os.getenv('DIFY_BASE_URL')
+    maeve_api_key: str = os.getenv('MAEVE_DIFY_API_KEY')  # Maeve doesn't answer without it
+    teddy_api_key: str = os.getenv('TEDDY_DIFY_API_KEY')
+    # several Dify instances of an app, only DIFY_BASE_URL is used when empty
+    backends: tuple[tuple[str, str | None], ...] = _backends('DIFY_BACKENDS')
+    maeve_backends: tuple[tuple[str, str | None], ...] = _backends('MAEVE_DIFY_BACKENDS')
+    teddy_backends: tuple[tuple[str, str | None], ...] = _backends('TEDDY_DIFY_BACKENDS')
+    max_concurrency: int = int(os.getenv('DIFY_MAX_CONCURRENCY', 8))
+    max_queue: int = int(os.getenv('DIFY_MAX_QUEUE', 100))
+    # waiting requests at which private, mention, welcome and news requests are shed, e.g. "100,75,50,25"
+    shed_thresholds: tuple[int, ...] = tuple(
+        int(n) for n in os.getenv('DIFY_SHED_THRESHOLDS', '').split(',') if n.strip()
+    )
+    busy_reply: str = os.getenv('DIFY_BUSY_REPLY') or '当前消息太多，请稍后再试 🙏'
+    deadline: float = float(os.getenv('DIFY_DEADLINE', 120))
+    max_retries: int = int(os.getenv('DIFY_MAX_RETRIES', 2))
+    breaker_failures: int = int(os.getenv('DIFY_BREAKER_FAILURES', 5))
+    breaker_reset: float = float(os.getenv('DIFY_BREAKER_RESET', 30))
+    hedge_percentile: float = float(os.getenv('DIFY_HEDGE_PERCENTILE', 0))
+    hedge_min_delay: float = float(os.getenv('DIFY_HEDGE_MIN_DELAY', 2))
+    unavailable_reply: str = os.getenv('DIFY_UNAVAILABLE_REPLY') or '服务暂时不可用，请稍后再试 🙏'
+
+
+@dataclass
+class HttpConfig:
+    """Connection pool shared by the Dify and news clients."""
+
+    limit: int = int(os.getenv('HTTP_POOL_LIMIT', 100))
+    limit_per_host: int = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 0))
+    keepalive_timeout: float = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 60))
+    dns_cache_ttl: int = int(os.getenv('HTTP_DNS_CACHE_TTL', 300))
+    connect_timeout: float = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+    verify_ssl: bool = os.getenv('HTTP_VERIFY_SSL', 'true').lower() == 'true'
+    warmup_connections: int = int(os.getenv('HTTP_WARMUP_CONNECTIONS', 2))
 
 
 @dataclass
 class NewsConfig:
+    """News workflow, generated ``prefetch_lead`` seconds before each slot and posted to every group."""
+
     api_key: str = os.getenv('NEWS_API_KEY')
     base_url: str = os.getenv('NEWS_BASE_URL')
+    groups: tuple[int | str, ...] = _chat_ids(os.getenv('NEWS_GROUP_IDS') or os.getenv('TG_GROUP_ID'))
+    min_interval: float = float(os.getenv('NEWS_MIN_INTERVAL', 60 * 60 * 10))
+    max_interval: float = float(os.getenv('NEWS_MAX_INTERVAL', 60 * 60 * 18))
+    prefetch_lead: float = float(os.getenv('NEWS_PREFETCH_LEAD', 60 * 30))
+    send_spacing: float = float(os.getenv('NEWS_SEND_SPACING', 1))  # seconds between two groups
+    retry_interval: float = float(os.getenv('NEWS_RETRY_INTERVAL', 60 * 5))
+    state_path: str = os.getenv('NEWS_STATE_PATH') or 'data/news.json'
+    dialogue: bool = os.getenv('NEWS_DIALOGUE', 'false').lower() == 'true'  # played by Maeve, Teddy and Clementine
+    dialogue_state_path: str = os.getenv('NEWS_DIALOGUE_STATE_PATH') or 'data/dialogue.json'
+
+
+@dataclass
+class ConversationConfig:
+    """Conversation store configuration, an empty ``db_path`` keeps conversations in memory only."""
+
+    db_path: str = os.getenv('CONVERSATION_DB_PATH', 'data/conversations.sqlite3')
+    cache_size: int = int(os.getenv('CONVERSATION_CACHE_SIZE', 10000))
+    cache_ttl: int = int(os.getenv('CONVERSATION_CACHE_TTL', 60 * 60 * 24))
+    flush_interval: float = float(os.getenv('CONVERSATION_FLUSH_INTERVAL', 2))
+
+
+@dataclass
+class ResponseCacheConfig:
+    """Answers to repeated first messages, disabled when ``size`` is 0."""
+
+    size: int = int(os.getenv('RESPONSE_CACHE_SIZE', 0))
+    max_bytes: int = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+    ttl: float = float(os.getenv('RESPONSE_CACHE_TTL', 60 * 60))
+    max_query_length: int = int(os.getenv('RESPONSE_CACHE_MAX_QUERY_LENGTH', 200))
+
+
+@dataclass
+class WebhookConfig:
+    """Webhook ingress configuration, long polling is used when ``url`` is empty."""
+
+    url: str = os.getenv('WEBHOOK_URL')
+    host: str = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    port: int = int(os.getenv('WEBHOOK_PORT', 8080))
+    path: str = os.getenv('WEBHOOK_PATH', '/webhook')
+    secret: str = os.getenv('WEBHOOK_SECRET')
+    queue_size: int = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+    workers: int = int(os.getenv('WEBHOOK_WORKERS', 16))
+
+
+@dataclass
+class ClusterConfig:
+    """Multi-process mode, a single process handles everything when ``workers`` is 0."""
+
+    workers: int = int(os.getenv('CLUSTER_WORKERS', 0))
+    socket_dir: str = os.getenv('CLUSTER_SOCKET_DIR') or '/tmp/w3st-bot'
+    leader_lock: str = os.getenv('CLUSTER_LEADER_LOCK') or 'data/news.lock'
+    leader_retry: float = float(os.getenv('CLUSTER_LEADER_RETRY', 30))
+
+
+@dataclass
+class MetricsConfig:
+    """Prometheus metrics endpoint, disabled when ``port`` is 0."""
+
+    host: str = os.getenv('METRICS_HOST', '0.0.0.0')
+    port: int = int(os.getenv('METRICS_PORT', 0))
+    path: str = os.getenv('METRICS_PATH', '/metrics')
 
 
 @dataclass
@@ -39,5 +181,12 @@ class Configuration:
     bot = BotConfig()
     dify = DifyConfig()
     news = NewsConfig()
+    http = HttpConfig()
+    webhook = WebhookConfig()
+    conversations = ConversationConfig()
+    response_cache = ResponseCacheConfig()
+    welcome = WelcomeConfig()
+    metrics = MetricsConfig()
+    cluster = ClusterConfig()
 
 conf = Configuration()